@@ -0,0 +1,117 @@
+"""
+Module for data augmentation of whole minibatches on the training device
+"""
+import math
+
+import torch
+import torch.nn.functional as F
+
+class BatchAugmentation:
+    """
+    Randomly augments a minibatch of slices together with its segmentation masks, after
+    collation and on the device the batch is already on. Flips, rotations and elastic
+    deformation are folded into one sampling grid, so images and masks are resampled
+    once each: images bilinearly, masks with nearest neighbour so that labels stay labels.
+    Intensity jitter only applies to images.
+
+    Every transform is drawn independently per sample with its own probability. Random
+    parameters are drawn on the CPU from a generator of our own, so a given seed produces
+    the same augmentations on any device and regardless of other users of the global RNG
+    """
+    def __init__(self, seed=None, p_flip=0.5, p_rotate=0.5, max_rotation=15, p_elastic=0.3,
+                 elastic_alpha=0.03, elastic_grid=4, p_intensity=0.5, max_gain=0.1, max_bias=0.05):
+        """
+        Arguments:
+            seed {int} -- seed of the random augmentations, None to seed randomly
+            p_flip {float} -- probability of flipping a slice, for each of the two axes
+            p_rotate {float} -- probability of rotating a slice
+            max_rotation {float} -- maximum rotation in degrees, either way
+            p_elastic {float} -- probability of elastically deforming a slice
+            elastic_alpha {float} -- standard deviation of the displacement, as a fraction of the slice size
+            elastic_grid {int} -- size of the grid of random displacements that get smoothly interpolated
+            p_intensity {float} -- probability of jittering intensities of a slice
+            max_gain {float} -- maximum relative change of contrast
+            max_bias {float} -- maximum change of brightness
+        """
+        self.p_flip = p_flip
+        self.p_rotate = p_rotate
+        self.max_rotation = max_rotation
+        self.p_elastic = p_elastic
+        self.elastic_alpha = elastic_alpha
+        self.elastic_grid = elastic_grid
+        self.p_intensity = p_intensity
+        self.max_gain = max_gain
+        self.max_bias = max_bias
+
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def __call__(self, images, segs):
+        """
+        Augments a minibatch
+
+        Arguments:
+            images {Torch tensor} -- [N, 1, H, W] floating point images
+            segs {Torch tensor} -- [N, 1, H, W] integer masks
+
+        Returns:
+            tuple of augmented (images, segs), of the same shapes, dtypes and device
+        """
+        n = images.shape[0]
+
+        # Flips and rotation make up one affine transform per slice
+        flip_y = torch.where(self._chance(n, self.p_flip), -torch.ones(n), torch.ones(n))
+        flip_x = torch.where(self._chance(n, self.p_flip), -torch.ones(n), torch.ones(n))
+        angle = self._uniform(n, self.max_rotation) * math.pi / 180 * self._chance(n, self.p_rotate).float()
+        cos, sin = torch.cos(angle), torch.sin(angle)
+
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = cos * flip_x
+        theta[:, 0, 1] = -sin * flip_y
+        theta[:, 1, 0] = sin * flip_x
+        theta[:, 1, 1] = cos * flip_y
+
+        elastic = self._chance(n, self.p_elastic)
+        spatial = (flip_x < 0) | (flip_y < 0) | (angle != 0) | elastic
+
+        if spatial.any():
+            grid = F.affine_grid(theta.to(images.device), list(images.shape), align_corners=False)
+
+            if elastic.any():
+                # Random displacements on a coarse grid, upsampled to the slice size, give
+                # a smooth deformation field. Sampling coordinates span [-1, 1], hence the 2
+                noise = torch.randn(n, 2, self.elastic_grid, self.elastic_grid, generator=self.generator)
+                noise *= 2 * self.elastic_alpha * elastic.float().view(n, 1, 1, 1)
+                displacement = F.interpolate(noise.to(images.device), size=images.shape[2:],
+                                             mode="bicubic", align_corners=True)
+                grid = grid + displacement.permute(0, 2, 3, 1)
+
+            images = F.grid_sample(images, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+            segs = F.grid_sample(segs.float(), grid, mode="nearest", padding_mode="zeros",
+                                 align_corners=False).to(segs.dtype)
+
+        if self.p_intensity > 0:
+            jitter = self._chance(n, self.p_intensity).float()
+            gain = 1 + self._uniform(n, self.max_gain) * jitter
+            bias = self._uniform(n, self.max_bias) * jitter
+            images = images * gain.to(images.device, images.dtype).view(n, 1, 1, 1) \
+                + bias.to(images.device, images.dtype).view(n, 1, 1, 1)
+
+        return images, segs
+
+    def _chance(self, n, p):
+        """
+        Returns:
+            [n] boolean tensor, each element True with probability p
+        """
+        return torch.rand(n, generator=self.generator) < p
+
+    def _uniform(self, n, bound):
+        """
+        Returns:
+            [n] tensor of values drawn uniformly from [-bound, bound)
+        """
+        return (torch.rand(n, generator=self.generator) * 2 - 1) * bound
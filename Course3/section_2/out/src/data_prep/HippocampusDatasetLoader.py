@@ -2,61 +2,295 @@
 Module loads the hippocampus dataset into RAM
 """
 import os
+import json
+import time
+import hashlib
+from functools import partial
 from os import listdir
 from os.path import isfile, join
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 import numpy as np
+import nibabel as nib
 from medpy.io import load
 
 from utils.utils import med_reshape
+from data_prep.VolumeCache import VolumeCache, LazyVolume
 
-def LoadHippocampusData(root_dir, y_shape, z_shape):
+# Bump this whenever preprocessing changes so that existing caches get rebuilt
+CACHE_VERSION = 2
+
+def LoadHippocampusData(root_dir, y_shape, z_shape, cache_dir=None, workers=8, use_processes=False,
+                        lazy=False, lazy_cache_bytes=2**31):
     '''
     This function loads our dataset form disk into memory,
     reshaping output to common size
 
     Arguments:
-        volume {Numpy array} -- 3D array representing the volume
+        root_dir {string} -- directory with images and labels subdirectories
+        y_shape {int} -- size of the Y dimension of the output volumes
+        z_shape {int} -- size of the Z dimension of the output volumes
+        cache_dir {string} -- if set, preprocessed volumes are kept in this directory
+            and memory-mapped on subsequent runs instead of being loaded again
+        workers {int} -- number of volumes decoded and preprocessed concurrently
+        use_processes {bool} -- decode on a process pool instead of a thread pool
+        lazy {bool} -- do not load anything up front. Volumes are decoded from the source
+            files on first access and kept in an LRU cache, cache_dir is not used
+        lazy_cache_bytes {int} -- how many bytes of decoded volumes the LRU cache holds
 
     Returns:
-        Array of dictionaries with data stored in seg and image fields as 
-        Numpy arrays of shape [AXIAL_WIDTH, Y_SHAPE, Z_SHAPE]
+        Array of dictionaries with data stored in seg and image fields as
+        Numpy arrays of shape [AXIAL_WIDTH, Y_SHAPE, Z_SHAPE]. In lazy mode,
+        the dictionaries are LazyVolume objects that share one VolumeCache
     '''
 
     image_dir = os.path.join(root_dir, 'images')
     label_dir = os.path.join(root_dir, 'labels')
 
-    images = [f for f in listdir(image_dir) if (
-        isfile(join(image_dir, f)) and f[0] != ".")]
+    images = sorted([f for f in listdir(image_dir) if (
+        isfile(join(image_dir, f)) and f[0] != ".")])
+
+    if lazy:
+        # Only headers are read here, to know how many slices each volume has
+        cache = VolumeCache(lazy_cache_bytes)
+        offsets = volume_offsets(image_dir, images)
+        out = np.empty(len(images), dtype=object)
+        for i, f in enumerate(images):
+            out[i] = LazyVolume(f, offsets[i + 1] - offsets[i],
+                                partial(load_volume, image_dir, label_dir, f, y_shape, z_shape), cache)
+
+        print(f"Indexed {len(out)} files, total {offsets[-1]} slices, loading lazily")
+        return out
+
+    # Every volume gets a fixed place in the output, in the order of the sorted file
+    # names, so the result does not depend on which worker finishes first
+    if cache_dir:
+        fingerprint = dataset_fingerprint(image_dir, label_dir, images, y_shape, z_shape)
+        out = load_cache(cache_dir, fingerprint)
+        if out is None:
+            # Preprocessed volumes are written straight into the cache files
+            offsets = volume_offsets(image_dir, images)
+            image_block, label_block = create_cache(cache_dir, (offsets[-1], y_shape, z_shape))
+            load_volumes(image_dir, label_dir, images, offsets, image_block, label_block, workers, use_processes)
+            write_cache_index(cache_dir, fingerprint, images, offsets, image_block, label_block)
+            del image_block, label_block
+            out = load_cache(cache_dir, fingerprint)
+    else:
+        offsets = volume_offsets(image_dir, images)
+        image_block = np.empty((offsets[-1], y_shape, z_shape), dtype=np.float32)
+        label_block = np.empty((offsets[-1], y_shape, z_shape), dtype=np.uint8)
+        load_volumes(image_dir, label_dir, images, offsets, image_block, label_block, workers, use_processes)
+        out = [{"image": image_block[start:end], "seg": label_block[start:end], "filename": f}
+               for f, start, end in zip(images, offsets[:-1], offsets[1:])]
+
+    # Hippocampus dataset only takes about 300 Mb RAM, so we can afford to keep it all in RAM
+    print(f"Processed {len(out)} files, total {sum([x['image'].shape[0] for x in out])} slices")
+    return np.array(out)
+
+def volume_offsets(image_dir, images):
+    '''
+    Reads the X size of every volume from its NIfTI header, without decoding
+    the image data, and lays the volumes out one after another
+
+    Arguments:
+        image_dir {string} -- directory with images
+        images {list} -- file names of the images
+
+    Returns:
+        list of ints, volume i occupies slices offsets[i]:offsets[i+1]
+    '''
+    return np.cumsum([0] + [nib.load(os.path.join(image_dir, f)).shape[0] for f in images]).tolist()
+
+def load_volumes(image_dir, label_dir, images, offsets, image_block, label_block, workers=8, use_processes=False):
+    '''
+    Decodes and preprocesses volumes concurrently into preallocated arrays,
+    reporting progress and throughput as volumes complete
+
+    Arguments:
+        image_dir {string} -- directory with images
+        label_dir {string} -- directory with labels
+        images {list} -- file names of the images and their labels
+        offsets {list} -- volume offsets returned by volume_offsets
+        image_block {Numpy array} -- float32 array of shape [total slices, Y, Z] to fill
+        label_block {Numpy array} -- uint8 array of the same shape to fill
+        workers {int} -- number of volumes decoded concurrently
+        use_processes {bool} -- decode on a process pool instead of a thread pool
+    '''
+    y_shape, z_shape = image_block.shape[1:]
+
+    def load_into(i):
+        # Threads share memory with us, so they write their rows of the output directly
+        start, end = offsets[i], offsets[i + 1]
+        load_volume(image_dir, label_dir, images[i], y_shape, z_shape,
+                    image_out=image_block[start:end], label_out=label_block[start:end])
+
+    def copy_into(i, volume):
+        # Processes send their volumes back, which we copy into their rows of the output
+        image_block[offsets[i]:offsets[i + 1]] = volume["image"]
+        label_block[offsets[i]:offsets[i + 1]] = volume["seg"]
+
+    total_mb = sum(os.path.getsize(os.path.join(d, f)) for f in images for d in (image_dir, label_dir)) / 2**20
+    report_every = max(1, len(images) // 10)
+    start = time.time()
+
+    executor = ProcessPoolExecutor(workers) if use_processes else ThreadPoolExecutor(workers)
+    with executor:
+        if use_processes:
+            futures = {executor.submit(load_volume, image_dir, label_dir, f, y_shape, z_shape): i
+                       for i, f in enumerate(images)}
+        else:
+            futures = {executor.submit(load_into, i): i for i in range(len(images))}
+
+        for done, future in enumerate(as_completed(futures), 1):
+            volume = future.result()
+            if use_processes:
+                copy_into(futures[future], volume)
+
+            if done % report_every == 0 or done == len(images):
+                elapsed = time.time() - start
+                print(f"Loaded {done}/{len(images)} volumes, {done / elapsed:.1f} volumes/sec, "
+                      f"{total_mb * done / len(images) / elapsed:.1f} MB/sec")
+
+def load_volume(image_dir, label_dir, f, y_shape, z_shape, image_out=None, label_out=None):
+    '''
+    Loads a single image/label pair, normalizing the image and
+    reshaping both to common size
+
+    Arguments:
+        image_dir {string} -- directory with images
+        label_dir {string} -- directory with labels
+        f {string} -- file name of the image and its label
+        y_shape {int} -- size of the Y dimension of the output volumes
+        z_shape {int} -- size of the Z dimension of the output volumes
+        image_out {Numpy array} -- optional preallocated float32 array to write the image into
+        label_out {Numpy array} -- optional preallocated uint8 array to write the label into
+
+    Returns:
+        Dictionary with image and seg Numpy arrays and the filename
+    '''
+
+    # Images are loaded here using MedPy's load method. We will ignore header
+    # since we will not use it
+    image, _ = load(os.path.join(image_dir, f))
+    label, _ = load(os.path.join(label_dir, f))
 
-    out = []
+    # TASK: normalize all images (but not labels) so that values are in [0..1] range
+    # Training runs in float32 anyway, so we do not go through float64
+    image = image.astype(np.single) / np.max(image)
+
+    # We need to reshape data since CNN tensors that represent minibatches
+    # in our case will be stacks of slices and stacks need to be of the same size.
+    # In the inference pathway we will need to crop the output to that
+    # of the input image.
+    # Note that since we feed individual slices to the CNN, we only need to
+    # extend 2 dimensions out of 3. We choose to extend coronal and sagittal here
+
+    # TASK: med_reshape function is not complete. Go and fix it!
+    # med_reshape keeps the image dtype, and writes labels straight into uint8,
+    # which holds our 3 classes
+    image = med_reshape(image, new_shape=(image.shape[0], y_shape, z_shape), out=image_out)
+    label = med_reshape(label, new_shape=(label.shape[0], y_shape, z_shape), out=label_out, dtype=np.uint8)
+
+    # TASK: Why do we need to cast label to int?
+    # ANSWER: Because the label is a binary mask, and we need to have integer values for the mask to work correctly
+
+    return {"image": image, "seg": label, "filename": f}
+
+def dataset_fingerprint(image_dir, label_dir, images, y_shape, z_shape):
+    '''
+    Computes a hash that changes whenever any of the source files
+    or the output shape changes
+
+    Arguments:
+        image_dir {string} -- directory with images
+        label_dir {string} -- directory with labels
+        images {list} -- file names of the images and their labels
+        y_shape {int} -- size of the Y dimension of the output volumes
+        z_shape {int} -- size of the Z dimension of the output volumes
+
+    Returns:
+        string
+    '''
+    h = hashlib.sha1(f"{CACHE_VERSION} {y_shape} {z_shape}".encode())
     for f in images:
+        for path in (os.path.join(image_dir, f), os.path.join(label_dir, f)):
+            st = os.stat(path)
+            h.update(f"{f} {st.st_size} {st.st_mtime_ns}".encode())
 
-        # We would benefit from mmap load method here if dataset doesn't fit into memory
-        # Images are loaded here using MedPy's load method. We will ignore header 
-        # since we will not use it
-        image, _ = load(os.path.join(image_dir, f))
-        label, _ = load(os.path.join(label_dir, f))
+    return h.hexdigest()
 
-        # TASK: normalize all images (but not labels) so that values are in [0..1] range
-        image = image / np.max(image)
+def create_cache(cache_dir, shape):
+    '''
+    Creates the on-disk store for preprocessed volumes: all image slices go into
+    one float32 array and all label slices into one uint8 array. The store is only
+    picked up by load_cache once write_cache_index has been called
 
-        # We need to reshape data since CNN tensors that represent minibatches
-        # in our case will be stacks of slices and stacks need to be of the same size.
-        # In the inference pathway we will need to crop the output to that
-        # of the input image.
-        # Note that since we feed individual slices to the CNN, we only need to 
-        # extend 2 dimensions out of 3. We choose to extend coronal and sagittal here
+    Arguments:
+        cache_dir {string} -- directory to write the cache to
+        shape {tuple} -- [total slices, Y, Z]
 
-        # TASK: med_reshape function is not complete. Go and fix it!
-        image = med_reshape(image, new_shape=(image.shape[0], y_shape, z_shape))
-        label = med_reshape(label, new_shape=(label.shape[0], y_shape, z_shape)).astype(int)
+    Returns:
+        tuple of (image, label) writable memory-mapped Numpy arrays
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
 
-        # TASK: Why do we need to cast label to int?
-        # ANSWER: Because the label is a binary mask, and we need to have integer values for the mask to work correctly
+    # Remove the index first so that a half-written cache is never picked up
+    index_path = os.path.join(cache_dir, "index.json")
+    if os.path.exists(index_path):
+        os.remove(index_path)
 
-        out.append({"image": image, "seg": label, "filename": f})
+    images = np.lib.format.open_memmap(os.path.join(cache_dir, "images.npy"), mode="w+", dtype=np.float32, shape=shape)
+    labels = np.lib.format.open_memmap(os.path.join(cache_dir, "labels.npy"), mode="w+", dtype=np.uint8, shape=shape)
+    return images, labels
 
-    # Hippocampus dataset only takes about 300 Mb RAM, so we can afford to keep it all in RAM
-    print(f"Processed {len(out)} files, total {sum([x['image'].shape[0] for x in out])} slices")
-    return np.array(out)
+def write_cache_index(cache_dir, fingerprint, filenames, offsets, images, labels):
+    '''
+    Flushes the arrays created by create_cache and writes the index of the volume
+    offsets and file names, which makes the cache valid
+
+    Arguments:
+        cache_dir {string} -- directory with the cache
+        fingerprint {string} -- hash of the source files and shapes
+        filenames {list} -- file names of the volumes
+        offsets {list} -- volume i occupies slices offsets[i]:offsets[i+1]
+        images {Numpy memmap} -- filled image array
+        labels {Numpy memmap} -- filled label array
+    '''
+    images.flush()
+    labels.flush()
+
+    with open(os.path.join(cache_dir, "index.json"), "w") as index_file:
+        json.dump({
+            "fingerprint": fingerprint,
+            "filenames": list(filenames),
+            "offsets": list(offsets)}, index_file)
+
+def load_cache(cache_dir, fingerprint):
+    '''
+    Opens the on-disk store written by create_cache and write_cache_index without reading it into memory
+
+    Arguments:
+        cache_dir {string} -- directory with the cache
+        fingerprint {string} -- expected hash of the source files and shapes
+
+    Returns:
+        List of dictionaries with image and seg memory-mapped Numpy arrays and
+        the filename, or None if there is no cache or it is stale
+    '''
+    index_path = os.path.join(cache_dir, "index.json")
+    if not os.path.exists(index_path):
+        return None
+
+    with open(index_path) as index_file:
+        index = json.load(index_file)
+
+    if index["fingerprint"] != fingerprint:
+        print("Dataset cache is out of date, rebuilding")
+        return None
+
+    images = np.load(os.path.join(cache_dir, "images.npy"), mmap_mode="r")
+    labels = np.load(os.path.join(cache_dir, "labels.npy"), mmap_mode="r")
+    offsets = index["offsets"]
+
+    return [{"image": images[start:end], "seg": labels[start:end], "filename": f}
+            for f, start, end in zip(index["filenames"], offsets[:-1], offsets[1:])]
@@ -2,56 +2,154 @@
 Module for Pytorch dataset representations
 """
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+
+from data_prep.VolumeCache import LazyVolume
 
 class SlicesDataset(Dataset):
     """
     This class represents an indexable Torch dataset
-    which could be consumed by the PyTorch DataLoader class
+    which could be consumed by the PyTorch DataLoader class.
+    Use it with a BatchSampler and batch_size=None to get whole minibatches
+    from __getitems__ instead of collating them sample by sample
     """
     def __init__(self, data):
-        self.data = data
+        # The slice blocks take their shape from the first volume
+        if len(data) == 0:
+            raise ValueError("SlicesDataset needs at least one volume, got an empty split")
+
+        # Slices are numbered volume by volume. Slice i belongs to the volume v for which
+        # offsets[v] <= i < offsets[v + 1]
+        self.lazy = all(isinstance(d, LazyVolume) for d in data)
+        counts = [d.num_slices if self.lazy else d["image"].shape[0] for d in data]
+        self.offsets = np.cumsum([0] + counts)
+
+        if self.lazy:
+            # Volumes stay on disk and are decoded through their cache when first touched
+            self.volumes = list(data)
+            self.images = None
+            self.labels = None
+            return
 
-        self.slices = []
+        # All slices are copied once into two contiguous blocks of shape
+        # [TOTAL_SLICES, 1, H, W]: float32 images and uint8 labels. Samples and
+        # minibatches are then just views or gathers of these blocks
+        shape = (int(self.offsets[-1]), 1) + data[0]["image"].shape[1:]
+        images = np.empty(shape, dtype=np.float32)
+        labels = np.empty(shape, dtype=np.uint8)
 
-        for i, d in enumerate(data):
-            for j in range(d["image"].shape[0]):
-                self.slices.append((i, j))
+        for d, start, end in zip(data, self.offsets[:-1], self.offsets[1:]):
+            images[start:end, 0] = d["image"]
+            labels[start:end, 0] = d["seg"]
+
+        self.images = torch.from_numpy(images)
+        self.labels = torch.from_numpy(labels)
 
     def __getitem__(self, idx):
         """
         This method is called by PyTorch DataLoader class to return a sample with id idx
 
         Arguments: 
-            idx {int} -- id of sample
+            idx {int} -- id of sample, or a list of ids to get a whole minibatch
 
         Returns:
             Dictionary of 2 Torch Tensors of dimensions [1, W, H]
         """
-        slc = self.slices[idx]
+        if isinstance(idx, (list, tuple)):
+            return self.__getitems__(idx)
+
         sample = dict()
         sample["id"] = idx
 
-        # You could implement caching strategy here if dataset is too large to fit
-        # in memory entirely
-        # Also this would be the place to call transforms if data augmentation is used
-        
-        # TASK: Create two new keys in the "sample" dictionary, named "image" and "seg"
-        # The values are 3D Torch Tensors with image and label data respectively. 
-        # First dimension is size 1, and last two hold the voxel data from the respective
-        # slices. Write code that stores the 2D slice data in the last 2 dimensions of the 3D Tensors. 
-        # Your tensor needs to be of shape [1, patch_size, patch_size]
-        # Don't forget that you need to put a Torch Tensor into your dictionary element's value
-        # Hint: your 3D data sits in self.data variable, the id of the 3D volume from data array
-        # and the slice number are in the slc variable. 
-        # Hint2: You can use None notation like so: arr[None, :] to add size-1 
-        # dimension to a Numpy array
-        sample["image"] = torch.from_numpy(self.data[slc[0]]["image"][slc[1]][None, :])
-        sample["seg"] = torch.from_numpy(self.data[slc[0]]["seg"][slc[1]][None, :])
+        # Datasets too large to fit in memory entirely are loaded lazily, volume by volume
+        # Data augmentation is applied to whole minibatches on the training device, see BatchAugmentation
+        if self.lazy:
+            v = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+            volume = self.volumes[v].load()
+            j = idx - self.offsets[v]
+            sample["image"] = torch.from_numpy(np.ascontiguousarray(volume["image"][j:j + 1], dtype=np.float32))
+            sample["seg"] = torch.from_numpy(np.ascontiguousarray(volume["seg"][j:j + 1], dtype=np.uint8))
+            return sample
+
+        sample["image"] = self.images[idx]
+        sample["seg"] = self.labels[idx]
+
+        return sample
+
+    def __getitems__(self, indices):
+        """
+        Returns a whole minibatch at once, without building and collating
+        individual samples
+
+        Arguments:
+            indices {list} -- ids of samples
+
+        Returns:
+            Dictionary of 2 Torch Tensors of dimensions [N, 1, W, H]
+        """
+        sample = dict()
+        sample["id"] = torch.as_tensor(indices)
+
+        if self.lazy:
+            sample["image"], sample["seg"] = self._gather_lazy(np.asarray(indices))
+            return sample
+
+        # A run of consecutive ids is served as a view of the blocks with no copying,
+        # any other set of ids is gathered into a new tensor in one go. Repeated ids
+        # (DistributedSampler pads shards with them) are not a run
+        if len(indices) and np.array_equal(indices, np.arange(indices[0], indices[0] + len(indices))):
+            idx = slice(int(indices[0]), int(indices[0]) + len(indices))
+        else:
+            idx = sample["id"]
+
+        sample["image"] = self.images[idx]
+        sample["seg"] = self.labels[idx]
 
         return sample
 
+    def _gather_lazy(self, indices):
+        """
+        Gathers slices of lazily loaded volumes, fetching every volume
+        the minibatch touches from the cache once
+
+        Arguments:
+            indices {Numpy array} -- ids of samples
+
+        Returns:
+            tuple of Torch Tensors of dimensions [N, 1, W, H]: float32 images and uint8 labels
+        """
+        volume_ids = np.searchsorted(self.offsets, indices, side="right") - 1
+        images = labels = None
+
+        for v in np.unique(volume_ids):
+            volume = self.volumes[v].load()
+            if images is None:
+                shape = (len(indices), 1) + volume["image"].shape[1:]
+                images = np.empty(shape, dtype=np.float32)
+                labels = np.empty(shape, dtype=np.uint8)
+
+            rows = np.flatnonzero(volume_ids == v)
+            images[rows, 0] = volume["image"][indices[rows] - self.offsets[v]]
+            labels[rows, 0] = volume["seg"][indices[rows] - self.offsets[v]]
+
+        return torch.from_numpy(images), torch.from_numpy(labels)
+
+    def share_memory_(self):
+        """
+        Moves slice blocks to shared memory, so that DataLoader worker
+        processes can use them without copying. Lazily loaded datasets
+        have no blocks, every worker decodes volumes into its own cache
+
+        Returns:
+            self
+        """
+        if not self.lazy:
+            self.images.share_memory_()
+            self.labels.share_memory_()
+        return self
+
     def __len__(self):
         """
         This method is called by PyTorch DataLoader class to return number of samples in the dataset
@@ -59,4 +157,74 @@ class SlicesDataset(Dataset):
         Returns:
             int
         """
-        return len(self.slices)
+        return int(self.offsets[-1])
+
+class VolumeGroupedSampler(Sampler):
+    """
+    Shuffles slices of a lazily loaded dataset while keeping the volumes they come from
+    in cache. Every epoch, volumes are shuffled and split into groups of volumes_per_group,
+    and the slices of one group are shuffled together before moving on to the next group.
+    Each volume is then decoded once per epoch as long as the cache holds a whole group
+
+    In distributed training every process takes its own share of whole volumes, so that
+    volumes are still decoded by one process each. Shares are padded with their own
+    slices (or cut) to the same length, since all processes have to take the same
+    number of steps
+    """
+    def __init__(self, dataset, volumes_per_group=8, seed=None, num_replicas=1, rank=0, shuffle=True):
+        if num_replicas > len(dataset.offsets) - 1:
+            raise ValueError(f"Can not split {len(dataset.offsets) - 1} volumes between {num_replicas} processes")
+
+        self.offsets = dataset.offsets
+        self.volumes_per_group = volumes_per_group
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        # Distributed processes have to agree on the volume order, so they share a fixed seed.
+        # Otherwise, without a seed, every sampler still gets its own, reproducible within the run
+        if seed is None:
+            seed = 0 if num_replicas > 1 else int(torch.randint(2**31, ()).item())
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = -(-int(self.offsets[-1]) // num_replicas)
+
+    def set_epoch(self, epoch):
+        """
+        Sets the epoch that the next iteration shuffles for. Otherwise every
+        iteration moves on to the next epoch by itself
+        """
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState((self.seed + self.epoch) % 2**32)
+        self.epoch += 1
+
+        sizes = np.diff(self.offsets)
+        volumes = rng.permutation(len(sizes)) if self.shuffle else np.arange(len(sizes))
+
+        # Volumes are dealt out in order to the process with the fewest slices so far,
+        # which keeps shares close in size. Every process computes the same assignment
+        if self.num_replicas > 1:
+            totals = np.zeros(self.num_replicas, dtype=np.int64)
+            owners = np.empty(len(volumes), dtype=np.int64)
+            for i, v in enumerate(volumes):
+                owners[i] = np.argmin(totals)
+                totals[owners[i]] += sizes[v]
+            volumes = volumes[owners == self.rank]
+
+        indices = []
+        for g in range(0, len(volumes), self.volumes_per_group):
+            group = np.concatenate([np.arange(self.offsets[v], self.offsets[v + 1])
+                                    for v in volumes[g:g + self.volumes_per_group]])
+            indices.extend((rng.permutation(group) if self.shuffle else group).tolist())
+
+        if self.num_replicas == 1:
+            return iter(indices)
+
+        # Pad with the share's own slices, which are already in cache, or cut it
+        if indices and len(indices) < self.num_samples:
+            indices += (indices * -(-self.num_samples // len(indices)))[:self.num_samples - len(indices)]
+        return iter(indices[:self.num_samples])
+
+    def __len__(self):
+        return self.num_samples
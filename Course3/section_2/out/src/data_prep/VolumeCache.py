@@ -0,0 +1,109 @@
+"""
+Module for on-demand access to volumes of datasets that are too large to keep in RAM
+"""
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
+
+class VolumeCache:
+    """
+    Least recently used cache of decoded volumes, bounded by the number of bytes
+    their arrays take. Counts hits and misses so that the cache size and the order
+    of access can be tuned
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._reset()
+
+    def get(self, key, load):
+        """
+        Returns a cached volume, loading it on a miss. The most recently loaded
+        volume is always kept, even if it is larger than max_bytes on its own
+
+        Arguments:
+            key {hashable} -- identifies the volume
+            load {callable} -- returns the volume as a dictionary of Numpy arrays
+
+        Returns:
+            dictionary returned by load
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+
+        # Decoding happens outside of the lock, so that threads can load different
+        # volumes at the same time
+        value = load()
+        size = sum(v.nbytes for v in value.values() if hasattr(v, "nbytes"))
+
+        with self.lock:
+            self.misses += 1
+            if key not in self.entries:
+                self.entries[key] = (value, size)
+                self.bytes += size
+
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+
+        return value
+
+    def stats(self):
+        """
+        Returns:
+            dictionary with hits, misses, hit rate, number of cached volumes and their bytes
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "volumes": len(self.entries), "bytes": self.bytes}
+
+    def _reset(self):
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # DataLoader worker processes get an empty cache of the same size
+        # rather than a pickled copy of our volumes
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.max_bytes = state["max_bytes"]
+        self._reset()
+
+class LazyVolume(Mapping):
+    """
+    Stands in for a volume dictionary with image, seg and filename fields, decoding
+    the volume through a shared VolumeCache on first access of its arrays.
+    The number of slices is known up front, so datasets can be indexed without
+    decoding anything
+    """
+    def __init__(self, filename, num_slices, load, cache):
+        self.filename = filename
+        self.num_slices = num_slices
+        self._load = load
+        self.cache = cache
+
+    def load(self):
+        """
+        Returns:
+            dictionary with image and seg Numpy arrays and the filename
+        """
+        return self.cache.get(self.filename, self._load)
+
+    def __getitem__(self, key):
+        if key == "filename":
+            return self.filename
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(("image", "seg", "filename"))
+
+    def __len__(self):
+        return 3
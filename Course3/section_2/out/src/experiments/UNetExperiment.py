@@ -3,22 +3,165 @@ This module represents a UNet experiment and contains a class that handles
 the experiment lifecycle
 """
 import os
+import json
 import time
+import inspect
+import contextlib
+import multiprocessing
 
 import numpy as np
 import torch
 import torch.optim as optim
 import torch.nn.functional as F
+import torch.distributed as dist
 
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
+from torch.utils.data.distributed import DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
 
-from data_prep.SlicesDataset import SlicesDataset
-from utils.utils import log_to_tensorboard
-from utils.volume_stats import Dice3d, Jaccard3d
+from data_prep.SlicesDataset import SlicesDataset, VolumeGroupedSampler
+from data_prep.BatchAugmentation import BatchAugmentation
+from data_prep.HippocampusDatasetLoader import LoadHippocampusData
+from utils.utils import AsyncTensorboardLogger
+from utils.volume_stats import VolumeMetricsAccumulator, TestSetMetricsAccumulator
 from networks.RecursiveUNet import UNet
 from inference.UNetInferenceAgent import UNetInferenceAgent
 
+# Names of the label classes other than background
+CLASS_NAMES = ("anterior", "posterior")
+
+# Keyword arguments the installed DataLoader accepts. persistent_workers and
+# prefetch_factor only exist from torch 1.7 on
+DATALOADER_ARGS = frozenset(inspect.signature(DataLoader.__init__).parameters)
+
+def evaluate_volumes(inference_agent, volumes, indices=None):
+    """
+    Runs inference on test volumes and computes their metrics. Predictions are
+    fed to metric accumulators batch by batch as the agent produces them
+
+    Arguments:
+        inference_agent {UNetInferenceAgent} -- agent to run inference with
+        volumes {array of dictionaries} -- volumes with image, seg and filename fields
+        indices {list} -- positions of the volumes in the whole test set, used to
+            order results merged from several shards. Defaults to 0..len(volumes)-1
+
+    Returns:
+        TestSetMetricsAccumulator
+    """
+    if indices is None:
+        indices = range(len(volumes))
+
+    results = TestSetMetricsAccumulator()
+
+    for n, (index, x) in enumerate(zip(indices, volumes)):
+        volume_metrics = VolumeMetricsAccumulator()
+        for i, pred in inference_agent.iter_volume_inference(x["image"]):
+            volume_metrics.update(pred, x["seg"][i:i + pred.shape[0]])
+
+        # We compute and report Dice and Jaccard similarity coefficients which 
+        # assess how close our volumes are to each other, along with sensitivity
+        # and specificity overall and per class (anterior/posterior), and the
+        # slices with lowest and highest Dice
+        metrics = volume_metrics.result()
+        slice_dice = np.array(metrics["slice_dice"])
+        scored = np.flatnonzero(~np.isnan(slice_dice))
+
+        stats = {
+            "filename": x['filename'],
+            "dice": metrics["dice"],
+            "jaccard": metrics["jaccard"],
+            "sensitivity": metrics["sensitivity"],
+            "specificity": metrics["specificity"],
+            "dice_per_class": dict(zip(CLASS_NAMES, metrics["dice_per_class"])),
+            "sensitivity_per_class": dict(zip(CLASS_NAMES, metrics["sensitivity_per_class"]))
+            }
+        if len(scored):
+            lowest = int(scored[np.argmin(slice_dice[scored])])
+            highest = int(scored[np.argmax(slice_dice[scored])])
+            stats["lowest_slice_dice"] = {"slice": lowest, "dice": float(slice_dice[lowest])}
+            stats["highest_slice_dice"] = {"slice": highest, "dice": float(slice_dice[highest])}
+
+        results.add(index, stats)
+        print(f"{x['filename']} Dice {metrics['dice']:.4f}. {100*(n+1)/len(volumes):.2f}% complete")
+
+    return results
+
+# Inference agent of a test worker process, see _init_test_worker
+_worker_agent = None
+
+def _init_test_worker(parameter_file_path, num_threads, batch_size):
+    """
+    Initializes a test worker process with its own CPU inference agent. It runs the
+    same eager UNet as the serial test path, so results do not depend on the number
+    of workers
+    """
+    global _worker_agent
+    torch.set_num_threads(num_threads)
+    _worker_agent = UNetInferenceAgent(parameter_file_path=parameter_file_path, model=UNet(num_classes=3),
+                                       device="cpu", batch_size=batch_size)
+
+def _evaluate_test_shard(shard):
+    """
+    Evaluates a shard of (volumes, indices) in a test worker process
+    """
+    volumes, indices = shard
+    return evaluate_volumes(_worker_agent, volumes, indices)
+
+def run_distributed(config, split):
+    """
+    Trains with DistributedDataParallel on config.world_size CPU processes of this
+    machine, communicating over the gloo backend. Every process trains on its own
+    shard of the training slices. Rank 0 then runs the test and writes results.json.
+    Processes only receive the configuration and the split, and load the dataset
+    themselves from config.root_dir. Load it once in this process first, so that the
+    preprocessed cache in config.cache_dir exists and every process just maps it
+
+    Arguments:
+        config {Config} -- experiment configuration
+        split {dictionary} -- indices of train, val and test volumes
+
+    Returns:
+        results directory of the run
+    """
+    # All processes have to agree on where results go, so it is picked once up front
+    out_dir = os.path.join(config.test_results_dir, f'{time.strftime("%Y-%m-%d_%H%M", time.gmtime())}_{config.name}')
+
+    torch.multiprocessing.spawn(_distributed_worker, args=(config, split, out_dir),
+                                nprocs=config.world_size, join=True)
+    return out_dir
+
+def _distributed_worker(rank, config, split, out_dir):
+    """
+    Runs one process of distributed training, see run_distributed
+    """
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", str(config.master_port))
+    dist.init_process_group("gloo", rank=rank, world_size=config.world_size)
+
+    # Split the cores between processes so that they do not oversubscribe them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // config.world_size))
+
+    # Volumes are listed in sorted file order, so split indices mean the same volumes
+    # as in the parent process. Cached blocks are memory-mapped, not copied
+    dataset = LoadHippocampusData(config.root_dir, y_shape = config.patch_size, z_shape = config.patch_size,
+                                  cache_dir = config.cache_dir, workers = config.load_workers,
+                                  use_processes = config.load_processes, lazy = config.lazy_volumes,
+                                  lazy_cache_bytes = config.volume_cache_mb * 2**20)
+
+    try:
+        exp = UNetExperiment(config, split, dataset, rank=rank, world_size=config.world_size, out_dir=out_dir)
+        exp.run()
+
+        if rank == 0:
+            results_json = exp.run_test()
+            results_json["config"] = vars(config)
+
+            with open(os.path.join(exp.out_dir, "results.json"), 'w') as out_file:
+                json.dump(results_json, out_file, indent=2, separators=(',', ': '))
+    finally:
+        dist.destroy_process_group()
+
 class UNetExperiment:
     """
     This class implements the basic life cycle for a segmentation task with UNet(https://arxiv.org/abs/1505.04597).
@@ -30,35 +173,49 @@ class UNetExperiment:
                 validate()
         test()
     """
-    def __init__(self, config, split, dataset):
+    def __init__(self, config, split, dataset, rank=0, world_size=1, out_dir=None):
         self.n_epochs = config.n_epochs
         self.split = split
         self._time_start = ""
         self._time_end = ""
         self.epoch = 0
+        self.val_loss = None
         self.name = config.name
+        self.test_workers = config.test_workers
+        self.test_batch_size = config.test_batch_size
+
+        # In distributed training (see run_distributed) this is one of world_size processes.
+        # Only rank 0 writes checkpoints and Tensorboard logs
+        self.rank = rank
+        self.world_size = world_size
+        self.distributed = world_size > 1
 
         # Create output folders
-        dirname = f'{time.strftime("%Y-%m-%d_%H%M", time.gmtime())}_{self.name}'
-        self.out_dir = os.path.join(config.test_results_dir, dirname)
-        os.makedirs(self.out_dir, exist_ok=True)
+        if out_dir is None:
+            dirname = f'{time.strftime("%Y-%m-%d_%H%M", time.gmtime())}_{self.name}'
+            out_dir = os.path.join(config.test_results_dir, dirname)
+        self.out_dir = out_dir
+        if self.rank == 0:
+            os.makedirs(self.out_dir, exist_ok=True)
 
         # Create data loaders
         # TASK: SlicesDataset class is not complete. Go to the file and complete it. 
         # Note that we are using a 2D version of UNet here, which means that it will expect
         # batches of 2D slices.
-        self.train_loader = DataLoader(SlicesDataset(dataset[split["train"]]),
-                batch_size=config.batch_size, shuffle=True, num_workers=0)
-        self.val_loader = DataLoader(SlicesDataset(dataset[split["val"]]),
-                batch_size=config.batch_size, shuffle=True, num_workers=0)
+        # In distributed training every process gets its own shard of both sets
+        self.train_loader = self.create_loader(SlicesDataset(dataset[split["train"]]), config, rank, world_size)
+        self.val_loader = self.create_loader(SlicesDataset(dataset[split["val"]]), config, rank, world_size, shuffle=False)
 
         # we will access volumes directly for testing
         self.test_data = dataset[split["test"]]
 
-        # Do we have CUDA available?
-        if not torch.cuda.is_available():
-            print("WARNING: No CUDA device is found. This may take significantly longer!")
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        # Do we have CUDA available? Distributed training runs on CPU processes
+        if self.distributed:
+            self.device = torch.device("cpu")
+        else:
+            if not torch.cuda.is_available():
+                print("WARNING: No CUDA device is found. This may take significantly longer!")
+            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
         # Configure our model and other training implements
         # We will use a recursive UNet model from German Cancer Research Center, 
@@ -67,6 +224,35 @@ class UNetExperiment:
         self.model = UNet(num_classes=3)
         self.model.to(self.device)
 
+        # Optional mixed precision and channels-last memory format. bfloat16 autocast
+        # works on CPU as well as CUDA. Gradient scaling is only needed (and only
+        # supported) for float16 on CUDA. Both options are opt-in because they need a newer
+        # torch than the pinned one: torch.autocast 1.10 (GradScaler, from 1.6, comes
+        # with it) and the channels-last memory format 1.5
+        if config.autocast_dtype and not hasattr(torch, "autocast"):
+            raise Exception(f"autocast_dtype requires torch 1.10 or newer, found {torch.__version__}")
+        if config.channels_last and not hasattr(torch, "channels_last"):
+            raise Exception(f"channels_last requires torch 1.5 or newer, found {torch.__version__}")
+        self.autocast_dtype = getattr(torch, config.autocast_dtype) if config.autocast_dtype else None
+        self.channels_last = config.channels_last
+        if self.channels_last:
+            self.model.to(memory_format=torch.channels_last)
+
+        # DistributedDataParallel averages gradients of all processes during backward, so
+        # every process takes the same optimizer steps. self.model stays the plain UNet
+        # for saving, loading and inference
+        self.train_model = DistributedDataParallel(self.model) if self.distributed else self.model
+
+        self.scaler = None
+        if self.autocast_dtype == torch.float16 and self.device.type == "cuda":
+            self.scaler = torch.cuda.amp.GradScaler()
+
+        # Training batches are augmented on the training device after they are loaded,
+        # so augmentation does not slow the data loader down
+        # Every distributed process gets its own seed, so that shards are augmented differently
+        seed = None if config.augmentation_seed is None else config.augmentation_seed + rank
+        self.augmentation = BatchAugmentation(seed=seed) if config.augment else None
+
         # We are using a standard cross-entropy loss since the model output is essentially
         # a tensor with softmax'd prediction of each pixel's probability of belonging 
         # to a certain class
@@ -78,8 +264,88 @@ class UNetExperiment:
         self.scheduler = optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, 'min')
 
         # Set up Tensorboard. By default it saves data into runs folder. You need to launch
-        self.tensorboard_train_writer = SummaryWriter(comment="_train")
-        self.tensorboard_val_writer = SummaryWriter(comment="_val")
+        # Rendering image grids is slow, so it happens on background threads and
+        # at its own, lower rate than loss logging. Only rank 0 logs
+        self.train_logger = self.val_logger = None
+        if self.rank == 0:
+            self.tensorboard_train_writer = SummaryWriter(comment="_train")
+            self.tensorboard_val_writer = SummaryWriter(comment="_val")
+            self.train_logger = AsyncTensorboardLogger(self.tensorboard_train_writer, as_figures=config.log_images_as_figures)
+            self.val_logger = AsyncTensorboardLogger(self.tensorboard_val_writer, as_figures=config.log_images_as_figures)
+        self.log_scalar_interval = config.log_scalar_interval
+        self.log_image_interval = config.log_image_interval
+
+    @staticmethod
+    def create_loader(dataset, config, rank=0, world_size=1, shuffle=True):
+        """
+        Creates a data loader that serves shuffled minibatches from the dataset,
+        with worker processes, prefetching and pinned memory set up from config
+
+        Arguments:
+            dataset {SlicesDataset} -- dataset to load from
+            config {Config} -- experiment configuration
+            rank {int} -- rank of this process in distributed training
+            world_size {int} -- number of processes in distributed training. With more than
+                one, every process loads its own shard of the dataset
+            shuffle {bool} -- shuffle the shards, only used in distributed training
+
+        Returns:
+            DataLoader
+        """
+        # Samplers hand out lists of indices and SlicesDataset returns whole minibatches
+        # for them, so automatic batching is turned off with batch_size=None.
+        # Lazily loaded datasets are shuffled a group of volumes at a time, so that
+        # minibatches draw from volumes that are already in the cache
+        # In distributed training, samplers of all processes shuffle with the same seed and
+        # epoch, so shards do not overlap. Lazily loaded datasets are sharded by whole volumes,
+        # other datasets take every world_size-th slice
+        if dataset.lazy:
+            sampler = VolumeGroupedSampler(dataset, config.volumes_per_group,
+                                           num_replicas=world_size, rank=rank, shuffle=shuffle or world_size == 1)
+        elif world_size > 1:
+            sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=shuffle)
+        else:
+            sampler = RandomSampler(dataset)
+
+        loader_args = dict(
+            batch_size=None,
+            sampler=BatchSampler(sampler, config.batch_size, drop_last=False),
+            num_workers=config.num_workers,
+            # Pinned memory only helps copying to a CUDA device
+            pin_memory=config.pin_memory and torch.cuda.is_available())
+
+        if config.num_workers > 0:
+            # Move slice blocks to shared memory so that worker processes map them
+            # instead of receiving a pickled copy of the whole dataset each
+            dataset.share_memory_()
+            # Older torch versions do not have these options and always restart
+            # workers every epoch, with 2 batches prefetched per worker
+            worker_args = dict(
+                persistent_workers=config.persistent_workers,
+                prefetch_factor=config.prefetch_factor)
+            loader_args.update((k, v) for k, v in worker_args.items() if k in DATALOADER_ARGS)
+
+        return DataLoader(dataset, **loader_args)
+
+    def _to_device(self, images):
+        """
+        Copies a batch of images to the training device, in channels-last
+        memory format if it is enabled
+        """
+        images = images.to(self.device, non_blocking=True)
+        if self.channels_last:
+            images = images.contiguous(memory_format=torch.channels_last)
+        return images
+
+    def _autocast(self):
+        """
+        Returns:
+            autocast context for the configured dtype, or a no-op context
+            if mixed precision is off
+        """
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device.type, dtype=self.autocast_dtype)
 
     def train(self):
         """
@@ -89,6 +355,12 @@ class UNetExperiment:
         print(f"Training epoch {self.epoch}...")
         self.model.train()
 
+        # Distributed samplers reshuffle per epoch, consistently across processes
+        # The loader's sampler is a BatchSampler around the per-slice sampler
+        sampler = self.train_loader.sampler.sampler
+        if isinstance(sampler, (DistributedSampler, VolumeGroupedSampler)):
+            sampler.set_epoch(self.epoch)
+
         # Loop over our minibatches
         for i, batch in enumerate(self.train_loader):
             self.optimizer.zero_grad()
@@ -96,36 +368,47 @@ class UNetExperiment:
             # TASK: You have your data in batch variable. Put the slices as 4D Torch Tensors of 
             # shape [BATCH_SIZE, 1, PATCH_SIZE, PATCH_SIZE] into variables data and target. 
             # Feed data to the model and feed target to the loss function
-            # 
-            data = batch["image"].to(self.device).float()
-            target = batch["seg"].to(self.device).long()
+            # Labels come in as uint8 and are only widened to long on the device,
+            # which keeps host-to-device copies small
+            data = batch["image"].to(self.device, non_blocking=True).float()
+            target = batch["seg"].to(self.device, non_blocking=True).long()
 
-            prediction = self.model(data)
+            if self.augmentation is not None:
+                data, target = self.augmentation(data, target)
+            data = self._to_device(data)
 
-            # We are also getting softmax'd version of prediction to output a probability map
-            # so that we can see how the model converges to the solution
-            prediction_softmax = F.softmax(prediction, dim=1)
+            with self._autocast():
+                prediction = self.train_model(data)
 
-            loss = self.loss_function(prediction, target[:, 0, :, :])
+                loss = self.loss_function(prediction, target[:, 0, :, :])
 
             # TASK: What does each dimension of variable prediction represent?
             # ANSWER: Each dimension of variable prediction represents the probability of the pixel belonging to a certain class.
 
-            loss.backward()
-            self.optimizer.step()
+            if self.scaler is not None:
+                self.scaler.scale(loss).backward()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+            else:
+                loss.backward()
+                self.optimizer.step()
 
-            if (i % 10) == 0:
-                # Output to console on every 10th batch
+            counter = 100*self.epoch + 100*(i/len(self.train_loader))
+
+            if (i % self.log_scalar_interval) == 0 and self.train_logger is not None:
+                # Output loss to console and Tensorboard every log_scalar_interval batches
                 print(f"\nEpoch: {self.epoch} Train loss: {loss}, {100*(i+1)/len(self.train_loader):.1f}% complete")
+                self.train_logger.log_scalar("Loss", loss.item(), counter)
 
-                counter = 100*self.epoch + 100*(i/len(self.train_loader))
+            if (i % self.log_image_interval) == 0 and self.train_logger is not None:
+                # We are also getting softmax'd version of prediction to output a probability map
+                # so that we can see how the model converges to the solution
+                prediction_softmax = F.softmax(prediction.detach(), dim=1)
 
-                # You don't need to do anything with this function, but you are welcome to 
-                # check it out if you want to see how images are logged to Tensorboard
-                # or if you want to output additional debug data
-                log_to_tensorboard(
-                    self.tensorboard_train_writer,
-                    loss,
+                # Images are rendered and written on a background thread. You are welcome to
+                # check out log_images_to_tensorboard if you want to see how images are logged
+                # to Tensorboard or if you want to output additional debug data
+                self.train_logger.log_images(
                     data,
                     target,
                     prediction_softmax,
@@ -134,6 +417,14 @@ class UNetExperiment:
 
             print(".", end='')
 
+        # With lazily loaded volumes, show how well the cache keeps up. Worker processes
+        # have caches of their own, so this only counts loads done on this process
+        dataset = self.train_loader.dataset
+        if dataset.lazy and dataset.volumes[0].cache.stats()["misses"]:
+            stats = dataset.volumes[0].cache.stats()
+            print(f"\nVolume cache: {stats['hits']} hits, {stats['misses']} misses, "
+                  f"{stats['volumes']} volumes, {stats['bytes'] / 2**20:.0f} MB")
+
         print("\nTraining complete")
 
     def validate(self):
@@ -153,27 +444,37 @@ class UNetExperiment:
             for i, batch in enumerate(self.val_loader):
                 
                 # TASK: Write validation code that will compute loss on a validation sample
-                data = batch["image"].to(self.device).float()
-                target = batch["seg"].to(self.device).long()
-                prediction = self.model(data)
-                prediction_softmax = F.softmax(prediction, dim=1)
-                loss = self.loss_function(prediction, target[:, 0, :, :])
+                data = self._to_device(batch["image"]).float()
+                target = batch["seg"].to(self.device, non_blocking=True).long()
+                with self._autocast():
+                    prediction = self.model(data)
+                    prediction_softmax = F.softmax(prediction, dim=1)
+                    loss = self.loss_function(prediction, target[:, 0, :, :])
 
                 print(f"Batch {i}. Data shape {data.shape} Loss {loss}")
 
                 # We report loss that is accumulated across all of validation set
                 loss_list.append(loss.item())
 
-        self.scheduler.step(np.mean(loss_list))
-
-        log_to_tensorboard(
-            self.tensorboard_val_writer,
-            np.mean(loss_list),
-            data,
-            target,
-            prediction_softmax, 
-            prediction,
-            (self.epoch+1) * 100)
+        # In distributed training, every process has validated its own shard. Summing losses
+        # and batch counts over all processes gives every one of them the same mean loss,
+        # so their schedulers stay in step
+        if self.distributed:
+            totals = torch.tensor([float(np.sum(loss_list)), float(len(loss_list))], dtype=torch.float64)
+            dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+            self.val_loss = (totals[0] / totals[1]).item()
+        else:
+            self.val_loss = np.mean(loss_list)
+        self.scheduler.step(self.val_loss)
+
+        if self.val_logger is not None:
+            self.val_logger.log_scalar("Loss", self.val_loss, (self.epoch+1) * 100)
+            self.val_logger.log_images(
+                data,
+                target,
+                prediction_softmax, 
+                prediction,
+                (self.epoch+1) * 100)
         print(f"Validation complete")
 
     def save_model_parameters(self):
@@ -214,63 +515,55 @@ class UNetExperiment:
         # on full 3D volumes, much like we will be doing it when we deploy the model in the 
         # clinical environment. 
 
-        # TASK: Inference Agent is not complete. Go and finish it. Feel free to test the class
-        # in a module of your own by running it against one of the data samples
-        inference_agent = UNetInferenceAgent(model=self.model, device=self.device)
-
-        out_dict = {}
-        out_dict["volume_stats"] = []
-        dc_list = []
-        jc_list = []
-        sensitivity_list = []
-
-        # for every in test set
-        for i, x in enumerate(self.test_data):
-            pred_label = inference_agent.single_volume_inference(x["image"])
-
-            # We compute and report Dice and Jaccard similarity coefficients which 
-            # assess how close our volumes are to each other
-
-            # TASK: Dice3D and Jaccard3D functions are not implemented. 
-            #  Complete the implementation as we discussed
-            # in one of the course lessons, you can look up definition of Jaccard index 
-            # on Wikipedia. If you completed it
-            # correctly (and if you picked your train/val/test split right ;)),
-            # your average Jaccard on your test set should be around 0.80
-
-            dc = Dice3d(pred_label, x["seg"])
-            jc = Jaccard3d(pred_label, x["seg"])
-            dc_list.append(dc)
-            jc_list.append(jc)
-
-            # STAND-OUT SUGGESTION: By way of exercise, consider also outputting:
-            # * Sensitivity and specificity (and explain semantic meaning in terms of 
-            #   under/over segmenting)
-            # * Dice-per-slice and render combined slices with lowest and highest DpS
-            # * Dice per class (anterior/posterior)
-
-            from sklearn.metrics import recall_score
-
-            # Calculate Sensitivity (Recall)
-            sensitivity = recall_score(x["seg"].ravel(), pred_label.ravel(), average='weighted')
-            sensitivity_list.append(sensitivity)
-
-            out_dict["volume_stats"].append({
-                "filename": x['filename'],
-                "dice": dc,
-                "jaccard": jc,
-                "sensitivity": sensitivity
-                })
-            print(f"{x['filename']} Dice {dc:.4f}. {100*(i+1)/len(self.test_data):.2f}% complete")
-
-        out_dict["overall"] = {
-            "mean_dice": np.mean(dc_list),
-            "mean_jaccard": np.mean(jc_list),
-            "mean_sensitivity": np.mean(sensitivity_list)}
+        # Metrics are accumulated while predictions stream out of the agent, so only
+        # one batch of predictions is held in memory at a time. Parallel workers
+        # create their own agents from the saved model parameters
+        if self.test_workers > 1:
+            out_dict = self._run_test_parallel().result()
+        else:
+            # TASK: Inference Agent is not complete. Go and finish it. Feel free to test the class
+            # in a module of your own by running it against one of the data samples
+            inference_agent = UNetInferenceAgent(model=self.model, device=self.device, batch_size=self.test_batch_size)
+            out_dict = evaluate_volumes(inference_agent, self.test_data).result()
 
         print("\nTesting complete.")
         return out_dict
 
+    def _run_test_parallel(self):
+        """
+        Evaluates the test set on a pool of CPU worker processes. Every worker loads
+        its own inference agent from the saved model parameters and evaluates
+        shards of test volumes. Results of all shards are merged, ordered by the
+        position of volumes in the test set
+
+        Returns:
+            TestSetMetricsAccumulator
+        """
+        # Workers load the parameters from disk, so the current ones are always saved
+        # first. A model.pth already in the results directory may be from an earlier run
+        model_path = os.path.join(self.out_dir, "model.pth")
+        self.save_model_parameters()
+
+        # Split torch threads between workers so that they do not oversubscribe the cores
+        num_threads = max(1, (os.cpu_count() or 1) // self.test_workers)
+
+        # Several shards per worker keep all workers busy until the end
+        n = len(self.test_data)
+        shard_size = max(1, -(-n // (self.test_workers * 4)))
+        shards = [(self.test_data[i:i + shard_size], list(range(i, min(i + shard_size, n))))
+                  for i in range(0, n, shard_size)]
+
+        results = TestSetMetricsAccumulator()
+
+        # Spawned processes do not inherit CUDA or OpenMP state from this one
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(self.test_workers, initializer=_init_test_worker,
+                          initargs=(model_path, num_threads, self.test_batch_size)) as pool:
+            for shard_results in pool.imap_unordered(_evaluate_test_shard, shards):
+                results.merge(shard_results)
+
+        return results
+
     def run(self):
         """
         Kicks off train cycle and writes model parameter file at the end
@@ -284,8 +577,14 @@ class UNetExperiment:
             self.train()
             self.validate()
 
-        # save model for inferencing
-        self.save_model_parameters()
+        # save model for inferencing. In distributed training all processes hold the same
+        # parameters, so rank 0 saves them for everyone
+        if self.rank == 0:
+            self.save_model_parameters()
+
+            # wait for pending Tensorboard images to be written
+            self.train_logger.close()
+            self.val_logger.close()
 
         self._time_end = time.time()
         print(f"Run complete. Total time: {time.strftime('%H:%M:%S', time.gmtime(self._time_end - self._time_start))}")
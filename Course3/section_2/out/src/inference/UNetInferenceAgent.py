@@ -4,7 +4,7 @@ Contains class that runs inferencing
 import torch
 import numpy as np
 
-from networks.RecursiveUNet import UNet
+from networks.InferenceUNet import InferenceUNet
 
 from utils.utils import med_reshape
 
@@ -12,33 +12,74 @@ class UNetInferenceAgent:
     """
     Stores model and parameters and some methods to handle inferencing
     """
-    def __init__(self, parameter_file_path='', model=None, device="cpu", patch_size=64):
+    def __init__(self, parameter_file_path='', model=None, device="cpu", patch_size=64, batch_size=None):
 
         self.model = model
         self.patch_size = patch_size
         self.device = device
-
-        if model is None:
-            self.model = UNet(num_classes=3)
-
-        if parameter_file_path:
-            self.model.load_state_dict(torch.load(parameter_file_path, map_location=self.device))
+        # Number of slices per forward pass. None means the whole volume goes in one batch
+        self.batch_size = batch_size
+
+        # parameter_file_path can also point to a model exported by export_model.py:
+        # a TorchScript module (.pt) or an ONNX graph (.onnx), which are loaded
+        # instead of the eager model
+        if model is None and parameter_file_path.endswith(".pt"):
+            self.model = torch.jit.load(parameter_file_path, map_location=self.device)
+        elif model is None and parameter_file_path.endswith(".onnx"):
+            self.model = OnnxModel(parameter_file_path)
+        else:
+            # Without a model we only ever run inference, so we build the variant of the
+            # UNet optimized for it. It loads the same parameters as the training UNet
+            if model is None:
+                self.model = InferenceUNet(num_classes=3)
+
+            if parameter_file_path:
+                self.model.load_state_dict(torch.load(parameter_file_path, map_location=self.device))
 
         self.model.to(device)
 
-    def single_volume_inference_unpadded(self, volume):
+        # Gaussian weight map used to blend overlapping tiles. Predictions near the
+        # tile borders see less context, so they get a lower weight than the center
+        coords = np.arange(patch_size) - (patch_size - 1) / 2
+        gauss = np.exp(-coords ** 2 / (2 * (patch_size / 8) ** 2))
+        self.tile_weights = torch.from_numpy(np.outer(gauss, gauss).astype(np.single)).to(device)
+
+    def single_volume_inference_unpadded(self, volume, overlap=0.5):
         """
-        Runs inference on a single volume of arbitrary patch size,
-        padding it to the conformant size first
+        Runs inference on a single volume of arbitrary patch size.
+        Slices smaller than the patch size are padded to it first, larger slices
+        are covered with overlapping patch_size x patch_size tiles whose
+        logits are blended together with a Gaussian weight map
 
         Arguments:
             volume {Numpy array} -- 3D array representing the volume
+            overlap {float} -- fraction of the patch size shared by neighbouring tiles
 
         Returns:
-            3D NumPy array with prediction mask
+            3D NumPy array with prediction mask of the same shape as volume
         """
-        
-        raise NotImplementedError
+        self.model.eval()
+
+        x, y, z = volume.shape
+        volume = med_reshape(volume, new_shape=(x, max(y, self.patch_size), max(z, self.patch_size)))
+        inputs = self._normalize_slices(volume)
+
+        logits = None
+        for y0 in self._tile_origins(volume.shape[1], overlap):
+            for z0 in self._tile_origins(volume.shape[2], overlap):
+                tiles = inputs[:, :, y0:y0 + self.patch_size, z0:z0 + self.patch_size]
+
+                for i, pred in self._batched_forward(tiles):
+                    if logits is None:
+                        logits = torch.zeros((x, pred.shape[1]) + volume.shape[1:], device=self.device)
+                    logits[i:i + pred.shape[0], :, y0:y0 + self.patch_size, z0:z0 + self.patch_size] += \
+                        pred * self.tile_weights
+
+        # Dividing the blended logits by the summed weights would not change
+        # the argmax, so we skip it
+        prediction = torch.argmax(logits, dim=1).cpu().numpy()
+
+        return prediction[:, :y, :z]
 
     def single_volume_inference(self, volume):
         """
@@ -50,18 +91,102 @@ class UNetInferenceAgent:
         Returns:
             3D NumPy array with prediction mask
         """
+        prediction = np.empty(volume.shape, dtype=np.int64)
+        for i, pred in self.iter_volume_inference(volume):
+            prediction[i:i + pred.shape[0]] = pred
+
+        return prediction
+
+    def iter_volume_inference(self, volume):
+        """
+        Runs inference on a single volume of conformant patch size, handing out
+        prediction masks batch by batch as soon as they are computed
+
+        Arguments:
+            volume {Numpy array} -- 3D array representing the volume
+
+        Returns:
+            Generator of (index of the first slice, 3D NumPy array with prediction
+            masks of the slices in the batch)
+        """
         self.model.eval()
 
         # Assuming volume is a numpy array of shape [X,Y,Z] and we need to slice X axis
-        slices = []
-
-        # TASK: Write code that will create mask for each slice across the X (0th) dimension. After 
-        # that, put all slices into a 3D Numpy array. You can verify if your method is 
-        # correct by running it on one of the volumes in your training set and comparing 
-        # with the label in 3D Slicer.
-        for i in range(volume.shape[0]):                            
-            inputs = torch.from_numpy(volume[i,:,:].astype(np.single) / np.max(volume[i,:,:])).unsqueeze(0).unsqueeze(0)
-            pred = self.model(inputs.to(self.device))
-            slices.append(torch.argmax(np.squeeze(pred.cpu().detach()), dim=0).numpy())
-
-        return np.array(slices)
+        inputs = self._normalize_slices(volume)
+
+        for i, pred in self._batched_forward(inputs):
+            yield i, torch.argmax(pred, dim=1).cpu().numpy()
+
+    def _normalize_slices(self, volume):
+        """
+        Normalizes every slice of the volume by its own maximum
+
+        Arguments:
+            volume {Numpy array} -- 3D array representing the volume
+
+        Returns:
+            Torch tensor of shape [X, 1, Y, Z]
+        """
+        # Done in a single pass over the whole volume. The maximum is cast to float32
+        # before dividing so that results match normalizing slices one by one bit for bit
+        slices = volume.astype(np.single) / np.max(volume, axis=(1, 2), keepdims=True).astype(np.single)
+        return torch.from_numpy(slices).unsqueeze(1)
+
+    def _batched_forward(self, inputs):
+        """
+        Feeds slices to the model in chunks of batch_size, or all at once
+        if batch_size is not set. No gradients are tracked
+
+        Arguments:
+            inputs {Torch tensor} -- [N, 1, Y, Z] tensor of normalized slices
+
+        Returns:
+            Generator of (index of the first slice in the chunk, model output for the chunk)
+        """
+        batch_size = self.batch_size or inputs.shape[0]
+        for i in range(0, inputs.shape[0], batch_size):
+            # Gradient tracking is only switched off around the forward pass itself,
+            # so that it is not left off for the caller while the generator is suspended
+            with torch.no_grad():
+                pred = self.model(inputs[i:i + batch_size].to(self.device))
+            yield i, pred
+
+    def _tile_origins(self, length, overlap):
+        """
+        Computes start positions of patch_size tiles covering a dimension.
+        The last tile is aligned to the end of the dimension
+
+        Arguments:
+            length {int} -- size of the dimension, at least patch_size
+            overlap {float} -- fraction of the patch size shared by neighbouring tiles
+
+        Returns:
+            list of ints
+        """
+        stride = max(1, int(self.patch_size * (1 - overlap)))
+        origins = list(range(0, length - self.patch_size + 1, stride))
+        if origins[-1] != length - self.patch_size:
+            origins.append(length - self.patch_size)
+
+        return origins
+
+class OnnxModel:
+    """
+    Runs an exported ONNX graph with ONNX Runtime behind the small part of the
+    torch.nn.Module interface that UNetInferenceAgent uses. Runs on CPU
+    """
+    def __init__(self, path):
+        # ONNX Runtime is only needed when running exported ONNX models
+        import onnxruntime
+
+        self.session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        return torch.from_numpy(self.session.run(None, {self.input_name: x.cpu().numpy()})[0])
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
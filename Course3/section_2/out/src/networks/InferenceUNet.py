@@ -0,0 +1,77 @@
+# Inference-optimized variant of the recursive UNet.
+# It is built from the same modules as RecursiveUNet.UNet, so it loads the same state_dict,
+# but runs them with fewer intermediate allocations:
+#   * conv-norm-activation and conv-activation layers run as a single chain of functional
+#     calls with in-place activation. These are the calls the modules make themselves, so
+#     the output is bit-identical to RecursiveUNet.UNet
+#   * the center crop of skip connections is skipped when shapes match (see RecursiveUNet)
+#   * skip connections are concatenated into buffers allocated once per input shape
+# Buffers are reused between calls, so this variant is for inference (no_grad) only.
+import torch
+import torch.nn.functional as F
+
+from torch import nn
+
+from networks.RecursiveUNet import UNet, UnetSkipConnectionBlock
+
+class InferenceUNet(UNet):
+    def __init__(self, **kwargs):
+        super(InferenceUNet, self).__init__(block=FusedSkipConnectionBlock, **kwargs)
+
+
+class ConvNormAct(nn.Sequential):
+    # Holds the same conv, (norm) and LeakyReLU layers as the Sequentials built by
+    # UnetSkipConnectionBlock.contract and expand, so parameter names do not change
+    def __init__(self, *layers):
+        super(ConvNormAct, self).__init__(*layers)
+
+        # Whether the layers can run as direct functional calls is decided once here rather
+        # than on every call. The layers are kept in a plain tuple, so they are not registered
+        # a second time and the state_dict keeps its 0, 1, 2 names
+        norm = layers[1] if len(layers) == 3 else None
+        self._fused = isinstance(norm, nn.InstanceNorm2d) and not norm.affine and not norm.track_running_stats
+        self._norm_eps = norm.eps if self._fused else None
+        self._layers = tuple(layers[:-1])
+        self._negative_slope = layers[-1].negative_slope
+
+    def forward(self, x):
+        if self._fused:
+            conv = self._layers[0]
+            # The bias is passed on even though the non-affine norm subtracts it right away:
+            # dropping it would change the floating point results
+            x = F.conv2d(x, conv.weight, conv.bias, conv.stride, conv.padding, conv.dilation, conv.groups)
+            x = F.instance_norm(x, eps=self._norm_eps)
+        else:
+            for layer in self._layers:
+                x = layer(x)
+
+        return F.leaky_relu_(x, self._negative_slope)
+
+
+class FusedSkipConnectionBlock(UnetSkipConnectionBlock):
+    def __init__(self, *args, **kwargs):
+        super(FusedSkipConnectionBlock, self).__init__(*args, **kwargs)
+        self._skip_buffer = None
+
+    @staticmethod
+    def contract(in_channels, out_channels, kernel_size=3, norm_layer=nn.InstanceNorm2d):
+        return ConvNormAct(*UnetSkipConnectionBlock.contract(in_channels, out_channels, kernel_size, norm_layer))
+
+    @staticmethod
+    def expand(in_channels, out_channels, kernel_size=3):
+        return ConvNormAct(*UnetSkipConnectionBlock.expand(in_channels, out_channels, kernel_size))
+
+    def forward(self, x):
+        if self.outermost:
+            return self.model(x)
+
+        crop = self.model(x)
+        if crop.size()[2:] != x.size()[2:]:
+            crop = self.center_crop(crop, x.size()[2], x.size()[3])
+
+        shape = (x.size(0), x.size(1) + crop.size(1)) + tuple(x.size()[2:])
+        buffer = self._skip_buffer
+        if buffer is None or buffer.size() != shape or buffer.dtype != x.dtype or buffer.device != x.device:
+            buffer = self._skip_buffer = torch.empty(shape, dtype=x.dtype, device=x.device)
+
+        return torch.cat([x, crop], 1, out=buffer)
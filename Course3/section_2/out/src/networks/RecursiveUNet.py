@@ -22,20 +22,24 @@ import torch
 from torch import nn
 
 class UNet(nn.Module):
-    def __init__(self, num_classes=3, in_channels=1, initial_filter_size=64, kernel_size=3, num_downs=4, norm_layer=nn.InstanceNorm2d):
+    def __init__(self, num_classes=3, in_channels=1, initial_filter_size=64, kernel_size=3, num_downs=4, norm_layer=nn.InstanceNorm2d, block=None):
         # norm_layer=nn.BatchNorm2d, use_dropout=False):
         super(UNet, self).__init__()
 
+        # |block| lets variants of the network swap in their own skip connection block class
+        if block is None:
+            block = UnetSkipConnectionBlock
+
         # construct unet structure
-        unet_block = UnetSkipConnectionBlock(in_channels=initial_filter_size * 2 ** (num_downs-1), out_channels=initial_filter_size * 2 ** num_downs,
-                                             num_classes=num_classes, kernel_size=kernel_size, norm_layer=norm_layer, innermost=True)
+        unet_block = block(in_channels=initial_filter_size * 2 ** (num_downs-1), out_channels=initial_filter_size * 2 ** num_downs,
+                           num_classes=num_classes, kernel_size=kernel_size, norm_layer=norm_layer, innermost=True)
         for i in range(1, num_downs):
-            unet_block = UnetSkipConnectionBlock(in_channels=initial_filter_size * 2 ** (num_downs-(i+1)),
-                                                 out_channels=initial_filter_size * 2 ** (num_downs-i),
-                                                 num_classes=num_classes, kernel_size=kernel_size, submodule=unet_block, norm_layer=norm_layer)
-        unet_block = UnetSkipConnectionBlock(in_channels=in_channels, out_channels=initial_filter_size,
-                                             num_classes=num_classes, kernel_size=kernel_size, submodule=unet_block, norm_layer=norm_layer,
-                                             outermost=True)
+            unet_block = block(in_channels=initial_filter_size * 2 ** (num_downs-(i+1)),
+                               out_channels=initial_filter_size * 2 ** (num_downs-i),
+                               num_classes=num_classes, kernel_size=kernel_size, submodule=unet_block, norm_layer=norm_layer)
+        unet_block = block(in_channels=in_channels, out_channels=initial_filter_size,
+                           num_classes=num_classes, kernel_size=kernel_size, submodule=unet_block, norm_layer=norm_layer,
+                           outermost=True)
 
         self.model = unet_block
 
@@ -109,5 +113,9 @@ class UnetSkipConnectionBlock(nn.Module):
         if self.outermost:
             return self.model(x)
         else:
-            crop = self.center_crop(self.model(x), x.size()[2], x.size()[3])
+            crop = self.model(x)
+            # padded convolutions keep the spatial size, so there is usually nothing to crop.
+            # Skipping the crop also keeps traced/exported graphs free of fixed input sizes
+            if crop.size()[2:] != x.size()[2:]:
+                crop = self.center_crop(crop, x.size()[2], x.size()[3])
             return torch.cat([x, crop], 1)
@@ -0,0 +1,196 @@
+"""
+This file contains code that turns a trained model into an int8 model for CPU deployment,
+using post-training static quantization calibrated on training slices.
+
+It expects a single command line argument with the results directory of a training run,
+containing model.pth and results.json. The test volumes listed in results.json are used to
+compare quantized and float models, calibration slices are sampled from the other volumes.
+Writes into the same directory:
+    * model_int8.pt - TorchScript module that UNetInferenceAgent can load
+    * quantization_report.json - Dice/Jaccard deltas, latency and size savings
+
+Eager mode int8 conversion of this network needs quantized InstanceNorm2d, LeakyReLU
+and ConvTranspose2d modules, which torch only has from version 1.8 on. The pinned
+training (1.3.1) and deployment (1.4) environments are too old: quantize with torch 1.8
+or newer, and load model_int8.pt with the same or a newer torch version, since TorchScript
+files do not load in older versions than the one that saved them.
+"""
+import io
+import os
+import sys
+import copy
+import json
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from torch.nn.quantized import FloatFunctional
+
+from networks.RecursiveUNet import UNet, UnetSkipConnectionBlock
+from inference.UNetInferenceAgent import UNetInferenceAgent
+from experiments.UNetExperiment import evaluate_volumes
+from data_prep.HippocampusDatasetLoader import LoadHippocampusData
+from run_ml_pipeline import Config
+
+# Oldest torch version that can quantize the UNet in eager mode, see the module docstring
+MIN_TORCH_VERSION = (1, 8)
+
+def check_torch_version():
+    """
+    Raises an exception if the installed torch is too old to quantize the UNet
+    """
+    version = tuple(int(v) for v in torch.__version__.split("+")[0].split(".")[:2])
+    if version < MIN_TORCH_VERSION:
+        raise Exception(f"Quantizing the UNet requires torch {'.'.join(map(str, MIN_TORCH_VERSION))} "
+                        f"or newer, found {torch.__version__}. The int8 model has to be loaded "
+                        f"with the same or a newer torch version as well")
+
+class QuantizableSkipConnectionBlock(UnetSkipConnectionBlock):
+    """
+    Skip connection block that concatenates through FloatFunctional, so that
+    post-training quantization can observe and quantize the concatenation.
+    Only used on the copy of the model that gets quantized
+    """
+    def forward(self, x):
+        if self.outermost:
+            return self.model(x)
+
+        crop = self.model(x)
+        if crop.size()[2:] != x.size()[2:]:
+            crop = self.center_crop(crop, x.size()[2], x.size()[3])
+        return self.skip_cat.cat([x, crop], 1)
+
+def make_quantizable(model):
+    """
+    Swaps the skip connection blocks of a UNet for QuantizableSkipConnectionBlock
+    in place. Parameters are left as they are
+
+    Arguments:
+        model {UNet} -- model to modify
+    """
+    # Blocks are collected first, since adding submodules while iterating over them is not allowed
+    blocks = [m for m in model.modules() if type(m) is UnetSkipConnectionBlock]
+    for block in blocks:
+        block.__class__ = QuantizableSkipConnectionBlock
+        block.skip_cat = FloatFunctional()
+
+def quantize_unet(model, calibration_volumes):
+    """
+    Quantizes weights and activations of the UNet to int8. Activation ranges are
+    calibrated by running inference on sample volumes
+
+    Arguments:
+        model {UNet} -- trained float model, left unchanged
+        calibration_volumes {list of Numpy arrays} -- 3D volumes to calibrate on
+
+    Returns:
+        quantized model, runs on CPU only
+    """
+    check_torch_version()
+
+    engines = torch.backends.quantized.supported_engines
+    torch.backends.quantized.engine = "fbgemm" if "fbgemm" in engines else "qnnpack"
+
+    # Quantize at the input and dequantize at the output, everything in between
+    # (convolutions, instance norms, LeakyReLUs, pooling, skip concatenations) runs in int8
+    float_copy = copy.deepcopy(model).cpu().eval()
+    make_quantizable(float_copy)
+    quantized = torch.quantization.QuantWrapper(float_copy)
+    quantized.qconfig = torch.quantization.get_default_qconfig(torch.backends.quantized.engine)
+
+    # Transposed convolutions only support per-tensor weight quantization
+    for module in quantized.modules():
+        if isinstance(module, nn.ConvTranspose2d):
+            module.qconfig = torch.quantization.QConfig(
+                activation=quantized.qconfig.activation,
+                weight=torch.quantization.default_weight_observer)
+
+    torch.quantization.prepare(quantized, inplace=True)
+
+    # Observers record activation ranges while we run inference the same way it is
+    # done in deployment, preprocessing included
+    agent = UNetInferenceAgent(model=quantized, device="cpu")
+    for volume in calibration_volumes:
+        agent.single_volume_inference(volume)
+
+    return torch.quantization.convert(quantized, inplace=True)
+
+def model_size(model):
+    """
+    Returns:
+        size of the serialized model parameters in bytes
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def evaluate(model, test_volumes):
+    """
+    Evaluates a model on the test volumes on CPU
+
+    Returns:
+        tuple of (overall metrics dictionary, mean seconds per volume)
+    """
+    agent = UNetInferenceAgent(model=model, device="cpu")
+    start = time.time()
+    overall = evaluate_volumes(agent, test_volumes).result()["overall"]
+    return overall, (time.time() - start) / len(test_volumes)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("You should supply one command line argument pointing to the results directory. Exiting.")
+        sys.exit()
+
+    run_dir = sys.argv[1]
+    c = Config()
+
+    # Fail before loading any data if this torch can not quantize the model
+    check_torch_version()
+
+    with open(os.path.join(run_dir, "results.json")) as results_file:
+        test_files = {v["filename"] for v in json.load(results_file)["volume_stats"]}
+
+    print("Loading data...")
+    data = LoadHippocampusData(c.root_dir, y_shape = c.patch_size, z_shape = c.patch_size, cache_dir = c.cache_dir,
+                               workers = c.load_workers, use_processes = c.load_processes,
+                               lazy = c.lazy_volumes, lazy_cache_bytes = c.volume_cache_mb * 2**20)
+    test_volumes = [x for x in data if x["filename"] in test_files]
+    train_volumes = [x for x in data if x["filename"] not in test_files]
+
+    # A few dozen volumes are plenty to calibrate activation ranges
+    rng = np.random.RandomState(0)
+    calibration = [train_volumes[i]["image"] for i in rng.choice(len(train_volumes), min(32, len(train_volumes)), replace=False)]
+
+    model = UNet(num_classes=3)
+    model.load_state_dict(torch.load(os.path.join(run_dir, "model.pth"), map_location="cpu"))
+    model.eval()
+
+    print("Calibrating and quantizing...")
+    quantized = quantize_unet(model, calibration)
+
+    print("Evaluating float model...")
+    float_metrics, float_latency = evaluate(model, test_volumes)
+    print("Evaluating quantized model...")
+    int8_metrics, int8_latency = evaluate(quantized, test_volumes)
+
+    report = {
+        "float": dict(float_metrics, seconds_per_volume=float_latency, model_bytes=model_size(model)),
+        "int8": dict(int8_metrics, seconds_per_volume=int8_latency, model_bytes=model_size(quantized)),
+        "delta": {k: int8_metrics[k] - float_metrics[k] for k in float_metrics}}
+    report["speedup"] = float_latency / int8_latency
+    report["size_reduction"] = report["float"]["model_bytes"] / report["int8"]["model_bytes"]
+    # model_int8.pt only loads with this or a newer torch version
+    report["torch_version"] = torch.__version__
+
+    with open(os.path.join(run_dir, "quantization_report.json"), 'w') as out_file:
+        json.dump(report, out_file, indent=2, separators=(',', ': '))
+
+    # Save as TorchScript, so that the deployment agent can load it without
+    # rebuilding the quantized model structure
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, torch.zeros(1, 1, c.patch_size, c.patch_size))
+    torch.jit.save(traced, os.path.join(run_dir, "model_int8.pt"))
+
+    print(json.dumps(report["delta"], indent=2))
+    print(f"Speedup {report['speedup']:.2f}x, size reduction {report['size_reduction']:.2f}x")
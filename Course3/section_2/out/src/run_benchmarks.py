@@ -0,0 +1,480 @@
+"""
+This file contains code that times performance-sensitive parts of the pipeline.
+Pass benchmark names on the command line to run a subset of them, e.g.:
+
+    python run_benchmarks.py inference
+"""
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+from functools import partial
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from networks.RecursiveUNet import UNet
+from inference.UNetInferenceAgent import UNetInferenceAgent
+from data_prep.SlicesDataset import SlicesDataset, VolumeGroupedSampler
+from data_prep.VolumeCache import VolumeCache, LazyVolume
+from data_prep.BatchAugmentation import BatchAugmentation
+from experiments.UNetExperiment import UNetExperiment
+from data_prep.HippocampusDatasetLoader import LoadHippocampusData
+from run_ml_pipeline import Config
+from utils.utils import mpl_image_grid, probability_map, image_grid, med_reshape, med_reshape_batch
+from utils.volume_stats import Dice3d, Jaccard3d, VolumeMetrics3d, BatchVolumeMetrics3d
+
+def make_dataset(n_volumes=20, n_slices=40, patch_size=64):
+    """
+    Builds a random dataset shaped like the output of LoadHippocampusData
+
+    Arguments:
+        n_volumes {int} -- number of volumes
+        n_slices {int} -- number of slices in each volume
+        patch_size {int} -- size of the Y and Z dimensions
+
+    Returns:
+        Array of dictionaries with image, seg and filename fields
+    """
+    rng = np.random.RandomState(0)
+    return np.array([{
+        "image": rng.rand(n_slices, patch_size, patch_size),
+        "seg": rng.randint(0, 3, (n_slices, patch_size, patch_size)),
+        "filename": f"volume_{i}.nii.gz"} for i in range(n_volumes)])
+
+def benchmark_inference(n_volumes=10, n_slices=40, patch_size=64, batch_sizes=(1, 8, 16, None)):
+    """
+    Times UNetInferenceAgent.single_volume_inference for several batch sizes
+    and checks that every batch size produces the same mask as batch size 1
+
+    Arguments:
+        n_volumes {int} -- number of volumes to run per batch size
+        n_slices {int} -- number of slices in each volume
+        patch_size {int} -- size of the Y and Z dimensions
+        batch_sizes {tuple} -- batch sizes to try, None means whole volume
+    """
+    torch.manual_seed(0)
+    model = UNet(num_classes=3)
+    volume = np.random.RandomState(0).rand(n_slices, patch_size, patch_size)
+
+    reference = UNetInferenceAgent(model=model, batch_size=1).single_volume_inference(volume)
+
+    for batch_size in batch_sizes:
+        agent = UNetInferenceAgent(model=model, batch_size=batch_size)
+        pred = agent.single_volume_inference(volume)
+
+        start = time.time()
+        for _ in range(n_volumes):
+            agent.single_volume_inference(volume)
+        elapsed = time.time() - start
+
+        print(f"batch_size={batch_size}: {n_volumes / elapsed:.2f} volumes/sec, "
+              f"identical to batch_size=1: {np.array_equal(pred, reference)}")
+
+def benchmark_data_loading(num_workers=(0, 2, 4), n_batches=20):
+    """
+    Compares how many minibatches per second the training loader delivers for
+    different numbers of worker processes with how many the model can consume
+
+    Arguments:
+        num_workers {tuple} -- worker counts to try
+        n_batches {int} -- number of training steps to time
+    """
+    config = Config()
+    dataset = SlicesDataset(make_dataset())
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    model = UNet(num_classes=3).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=config.learning_rate)
+    loss_function = torch.nn.CrossEntropyLoss()
+    batch = dataset[list(range(config.batch_size))]
+    data = batch["image"].to(device)
+    target = batch["seg"].to(device).long()
+
+    start = time.time()
+    for _ in range(n_batches):
+        optimizer.zero_grad()
+        loss_function(model(data), target[:, 0, :, :]).backward()
+        optimizer.step()
+    print(f"training step: {n_batches / (time.time() - start):.1f} batches/sec")
+
+    for workers in num_workers:
+        config.num_workers = workers
+        loader = UNetExperiment.create_loader(dataset, config)
+
+        start = time.time()
+        for batch in loader:
+            batch["image"].to(device, non_blocking=True)
+            batch["seg"].to(device, non_blocking=True)
+        print(f"num_workers={workers}: {len(loader) / (time.time() - start):.1f} batches/sec")
+
+def probability_map_loop(images):
+    """
+    Previous per-pixel implementation of probability_map, kept as a baseline
+
+    Arguments:
+        images {Torch tensor} -- Nx3xWxH array of softmax'd predictions
+
+    Returns:
+        list of nested lists of RGB values
+    """
+    out = []
+    for i in range(images.shape[0]):
+        vol = images[i].detach().numpy()
+        out.append([[[(1-vol[0,x,y])*vol[1,x,y], (1-vol[0,x,y])*vol[2,x,y], 0] \
+                        for y in range(vol.shape[2])] \
+                        for x in range(vol.shape[1])])
+    return out
+
+def benchmark_image_grid(sizes=(64, 256), repeats=5):
+    """
+    Times composition of 16 probability maps per-pixel and vectorized, as well as
+    rendering a whole grid as a Matplotlib figure and as a pre-tiled image
+
+    Arguments:
+        sizes {tuple} -- image sizes to try
+        repeats {int} -- number of times to repeat every measurement
+    """
+    import matplotlib.pyplot as plt
+
+    for size in sizes:
+        torch.manual_seed(0)
+        images = torch.softmax(torch.randn(16, 3, size, size), dim=1)
+
+        for name, function in (
+                ("probability map, per pixel", probability_map_loop),
+                ("probability map, vectorized", probability_map),
+                ("figure grid", lambda x: plt.close(mpl_image_grid(x))),
+                ("tiled image grid", image_grid)):
+            start = time.time()
+            for _ in range(repeats):
+                function(images)
+            print(f"{size}x{size} {name}: {1000 * (time.time() - start) / repeats:.1f} ms")
+
+def benchmark_metrics(n_volumes=20, n_slices=40, patch_size=64):
+    """
+    Times the single-pass confusion matrix metrics against Dice3d, Jaccard3d and
+    sklearn's recall_score, and checks that they agree
+
+    Arguments:
+        n_volumes {int} -- number of volume pairs
+        n_slices {int} -- number of slices in each volume
+        patch_size {int} -- size of the Y and Z dimensions
+    """
+    from sklearn.metrics import recall_score
+
+    data = make_dataset(n_volumes, n_slices, patch_size)
+    rng = np.random.RandomState(1)
+    preds = [np.where(rng.rand(*x["seg"].shape) < 0.9, x["seg"], rng.randint(0, 3, x["seg"].shape)) for x in data]
+
+    start = time.time()
+    reference = [(Dice3d(p, x["seg"]), Jaccard3d(p, x["seg"]),
+                  recall_score(x["seg"].ravel(), p.ravel(), average='weighted')) for p, x in zip(preds, data)]
+    print(f"Dice3d + Jaccard3d + recall_score: {n_volumes / (time.time() - start):.1f} volumes/sec")
+
+    start = time.time()
+    metrics = [VolumeMetrics3d(p, x["seg"]) for p, x in zip(preds, data)]
+    print(f"VolumeMetrics3d: {n_volumes / (time.time() - start):.1f} volumes/sec")
+
+    start = time.time()
+    batch = BatchVolumeMetrics3d(preds, [x["seg"] for x in data])
+    print(f"BatchVolumeMetrics3d: {n_volumes / (time.time() - start):.1f} volumes/sec")
+
+    for i, key in enumerate(("dice", "jaccard", "sensitivity")):
+        expected = [r[i] for r in reference]
+        print(f"{key} matches: {np.allclose(expected, [m[key] for m in metrics]) and np.allclose(expected, batch[key])}")
+
+def load_benchmark_dataset(config):
+    """
+    Loads the hippocampus dataset from config.root_dir if it is available,
+    otherwise builds a random dataset of the same shape
+
+    Returns:
+        Array of dictionaries with image, seg and filename fields
+    """
+    if os.path.isdir(config.root_dir):
+        return LoadHippocampusData(config.root_dir, y_shape=config.patch_size,
+                                   z_shape=config.patch_size, cache_dir=config.cache_dir,
+                                   workers=config.load_workers, use_processes=config.load_processes)
+    return make_dataset(n_volumes=40, patch_size=config.patch_size)
+
+def benchmark_training_modes(n_epochs=2):
+    """
+    Compares epoch time and validation loss of full precision training against
+    bfloat16 autocast and channels-last memory format, at the configured
+    batch_size and patch_size
+
+    Arguments:
+        n_epochs {int} -- number of epochs to train in every mode
+    """
+    config = Config()
+    config.test_results_dir = tempfile.mkdtemp()
+    data = load_benchmark_dataset(config)
+    keys = np.arange(len(data))
+    split = {"train": keys[:int(0.8 * len(keys))], "val": keys[int(0.8 * len(keys)):], "test": keys[:0]}
+
+    for autocast_dtype, channels_last in ((None, False), ("bfloat16", False), (None, True), ("bfloat16", True)):
+        config.autocast_dtype = autocast_dtype
+        config.channels_last = channels_last
+
+        torch.manual_seed(0)
+        exp = UNetExperiment(config, split, data)
+
+        losses = []
+        start = time.time()
+        for exp.epoch in range(n_epochs):
+            exp.train()
+            exp.validate()
+            losses.append(exp.val_loss)
+        elapsed = time.time() - start
+
+        exp.train_logger.close()
+        exp.val_logger.close()
+        print(f"autocast={autocast_dtype}, channels_last={channels_last}: "
+              f"{elapsed / n_epochs:.1f} s/epoch, validation losses {np.round(losses, 4).tolist()}")
+
+def med_reshape_zeros(image, new_shape):
+    """
+    Previous implementation of med_reshape, kept as a baseline
+    """
+    reshaped_image = np.zeros(new_shape)
+    reshaped_image[:image.shape[0], :image.shape[1], :image.shape[2]] = image
+    return reshaped_image
+
+def measure(function, *args, repeats=5, **kwargs):
+    """
+    Runs the function repeatedly, measuring mean wall time and peak traced memory
+
+    Returns:
+        tuple of (result, seconds per run, peak megabytes)
+    """
+    tracemalloc.start()
+    start = time.time()
+    for _ in range(repeats):
+        result = function(*args, **kwargs)
+    elapsed = (time.time() - start) / repeats
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, elapsed, peak / 2**20
+
+def benchmark_reshape(n_volumes=260, patch_size=64):
+    """
+    Compares wall time and peak memory of reshaping HippoCrop sized volumes with the
+    previous med_reshape, the dtype preserving one and the batched one, and checks
+    that all of them produce the same values
+
+    Arguments:
+        n_volumes {int} -- number of volumes, the size of the Hippocampus dataset by default
+        patch_size {int} -- size of the Y and Z dimensions
+    """
+    rng = np.random.RandomState(0)
+    shapes = [(rng.randint(30, 44), rng.randint(45, 57), rng.randint(30, 44)) for _ in range(n_volumes)]
+    images = [rng.rand(*shape).astype(np.single) for shape in shapes]
+    labels = [rng.randint(0, 3, shape).astype(np.uint8) for shape in shapes]
+
+    def reshape_all(reshape, volumes, **kwargs):
+        return [reshape(v, (v.shape[0], patch_size, patch_size), **kwargs) for v in volumes]
+
+    for name, volumes in (("images", images), ("labels", labels)):
+        reference, elapsed, peak = measure(reshape_all, med_reshape_zeros, volumes)
+        print(f"{name}, previous: {1000 * elapsed:.1f} ms, peak {peak:.1f} MB")
+
+        result, elapsed, peak = measure(reshape_all, med_reshape, volumes)
+        identical = all(np.array_equal(a, b) for a, b in zip(reference, result))
+        print(f"{name}, dtype preserving: {1000 * elapsed:.1f} ms, peak {peak:.1f} MB, identical: {identical}")
+
+        (block, offsets), elapsed, peak = measure(med_reshape_batch, volumes, (patch_size, patch_size))
+        identical = all(np.array_equal(a, block[start:stop]) for a, start, stop in zip(reference, offsets[:-1], offsets[1:]))
+        print(f"{name}, batched: {1000 * elapsed:.1f} ms, peak {peak:.1f} MB, identical: {identical}")
+
+def benchmark_ingestion(workers=(1, 4, 8)):
+    """
+    Times loading the hippocampus dataset from config.root_dir without a cache on
+    thread and process pools of several sizes, and checks that every run
+    produces the same volumes in the same order
+
+    Arguments:
+        workers {tuple} -- pool sizes to try
+    """
+    config = Config()
+    if not os.path.isdir(config.root_dir):
+        print(f"{config.root_dir} not found, skipping")
+        return
+
+    reference = None
+    for use_processes in (False, True):
+        for n in workers:
+            start = time.time()
+            data = LoadHippocampusData(config.root_dir, y_shape=config.patch_size, z_shape=config.patch_size,
+                                       workers=n, use_processes=use_processes)
+            elapsed = time.time() - start
+
+            if reference is None:
+                reference = data
+            identical = all(a["filename"] == b["filename"] and np.array_equal(a["image"], b["image"])
+                            and np.array_equal(a["seg"], b["seg"]) for a, b in zip(reference, data))
+            print(f"{'processes' if use_processes else 'threads'}, {n} workers: {elapsed:.1f}s, identical: {identical}")
+
+def make_volume(i, n_slices, patch_size):
+    """
+    Decodes volume i of a random lazily loaded dataset
+    """
+    rng = np.random.RandomState(i)
+    return {"image": rng.rand(n_slices, patch_size, patch_size).astype(np.single),
+            "seg": rng.randint(0, 3, (n_slices, patch_size, patch_size)).astype(np.uint8),
+            "filename": f"volume_{i}.nii.gz"}
+
+def benchmark_lazy_loading(n_volumes=64, n_slices=40, patch_size=64, cached_volumes=8, batch_size=8):
+    """
+    Compares volume cache hit rate and minibatch throughput of a lazily loaded dataset
+    shuffled by slice with one shuffled volume group by volume group
+
+    Arguments:
+        n_volumes {int} -- number of volumes
+        n_slices {int} -- number of slices in each volume
+        patch_size {int} -- size of the Y and Z dimensions
+        cached_volumes {int} -- how many volumes fit into the cache
+        batch_size {int} -- slices per minibatch
+    """
+    volume_bytes = n_slices * patch_size * patch_size * (4 + 1)
+
+    for name in ("random", "volume grouped"):
+        cache = VolumeCache(cached_volumes * volume_bytes)
+        data = [LazyVolume(f"volume_{i}.nii.gz", n_slices, partial(make_volume, i, n_slices, patch_size), cache)
+                for i in range(n_volumes)]
+        dataset = SlicesDataset(data)
+
+        if name == "random":
+            sampler = torch.utils.data.RandomSampler(dataset)
+        else:
+            sampler = VolumeGroupedSampler(dataset, volumes_per_group=cached_volumes, seed=0)
+
+        start = time.time()
+        n_batches = 0
+        for indices in torch.utils.data.BatchSampler(sampler, batch_size, drop_last=False):
+            dataset[indices]
+            n_batches += 1
+        elapsed = time.time() - start
+
+        stats = cache.stats()
+        print(f"{name}: {n_batches / elapsed:.1f} batches/sec, {stats['misses']} volume loads for "
+              f"{n_volumes} volumes, hit rate {100 * stats['hit_rate']:.1f}%")
+
+def benchmark_augmentation(batch_sizes=(8, 64), n_batches=50, patch_size=64):
+    """
+    Measures how many samples per second BatchAugmentation processes on the training
+    device, checks that a seed reproduces the same augmentations and that masks keep
+    their labels
+
+    Arguments:
+        batch_sizes {tuple} -- minibatch sizes to try
+        n_batches {int} -- number of minibatches to time per size
+        patch_size {int} -- size of the slices
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    for batch_size in batch_sizes:
+        images = torch.rand(batch_size, 1, patch_size, patch_size, device=device)
+        segs = torch.randint(0, 3, (batch_size, 1, patch_size, patch_size), device=device)
+
+        augmentation = BatchAugmentation(seed=0)
+        augmentation(images, segs)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+
+        start = time.time()
+        for _ in range(n_batches):
+            augmented_images, augmented_segs = augmentation(images, segs)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.time() - start
+
+        first = BatchAugmentation(seed=1)(images, segs)
+        second = BatchAugmentation(seed=1)(images, segs)
+        reproducible = torch.equal(first[0], second[0]) and torch.equal(first[1], second[1])
+        labels_kept = set(augmented_segs.unique().tolist()) <= {0, 1, 2}
+
+        print(f"batch size {batch_size}: {batch_size * n_batches / elapsed:.0f} samples/sec on {device.type}, "
+              f"reproducible: {reproducible}, labels kept: {labels_kept}")
+
+def _ddp_scaling_worker(rank, world_size, config, split, data, results):
+    """
+    Trains and validates one epoch as one of world_size processes, see benchmark_ddp_scaling
+    """
+    # Every run trains on CPU processes only, including the single process baseline
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(config.master_port + world_size)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+    torch.manual_seed(0)
+    exp = UNetExperiment(config, split, data, rank=rank, world_size=world_size, out_dir=config.test_results_dir)
+
+    # All processes start timing together
+    dist.barrier()
+    start = time.time()
+    exp.train()
+    exp.validate()
+    dist.barrier()
+    elapsed = time.time() - start
+
+    if rank == 0:
+        exp.train_logger.close()
+        exp.val_logger.close()
+        results.put((elapsed, exp.val_loss))
+    dist.destroy_process_group()
+
+def benchmark_ddp_scaling(world_sizes=None):
+    """
+    Measures how training throughput scales with the number of DistributedDataParallel
+    CPU processes, training and validating one epoch on the configured dataset
+
+    Arguments:
+        world_sizes {tuple} -- process counts to try, powers of two up to the number of cores by default
+    """
+    config = Config()
+    config.test_results_dir = tempfile.mkdtemp()
+    # Batches are loaded on the training processes, so that only training is compared
+    config.num_workers = 0
+    data = load_benchmark_dataset(config)
+    keys = np.arange(len(data))
+    split = {"train": keys[:int(0.8 * len(keys))], "val": keys[int(0.8 * len(keys)):], "test": keys[:0]}
+    n_slices = sum(data[k]["image"].shape[0] for k in split["train"])
+
+    if world_sizes is None:
+        world_sizes = [2 ** i for i in range(int(np.log2(os.cpu_count() or 1)) + 1)]
+
+    context = torch.multiprocessing.get_context("spawn")
+    baseline = None
+    for world_size in world_sizes:
+        results = context.SimpleQueue()
+        torch.multiprocessing.spawn(_ddp_scaling_worker, args=(world_size, config, split, data, results),
+                                    nprocs=world_size, join=True)
+        elapsed, val_loss = results.get()
+
+        if baseline is None:
+            baseline = elapsed
+        print(f"{world_size} processes: {elapsed:.1f} s/epoch, {n_slices / elapsed:.1f} slices/sec, "
+              f"speedup {baseline / elapsed:.2f}x, validation loss {val_loss:.4f}")
+
+BENCHMARKS = {
+    "inference": benchmark_inference,
+    "data_loading": benchmark_data_loading,
+    "image_grid": benchmark_image_grid,
+    "metrics": benchmark_metrics,
+    "training_modes": benchmark_training_modes,
+    "reshape": benchmark_reshape,
+    "ingestion": benchmark_ingestion,
+    "lazy_loading": benchmark_lazy_loading,
+    "augmentation": benchmark_augmentation,
+    "ddp_scaling": benchmark_ddp_scaling,
+}
+
+if __name__ == "__main__":
+    for name in (sys.argv[1:] or BENCHMARKS.keys()):
+        print(f"Running {name} benchmark...")
+        BENCHMARKS[name]()
@@ -2,9 +2,10 @@
 This file contains code that will kick off training and testing processes
 """
 import os
+import sys
 import json
 
-from experiments.UNetExperiment import UNetExperiment
+from experiments.UNetExperiment import UNetExperiment, run_distributed
 from data_prep.HippocampusDatasetLoader import LoadHippocampusData
 
 class Config:
@@ -19,6 +20,49 @@ class Config:
         self.batch_size = 8
         self.patch_size = 64
         self.test_results_dir = "runs"
+        # Preprocessed dataset is cached here and memory-mapped on later runs. Set to None to disable
+        self.cache_dir = "cache"
+        # Number of volumes decoded and preprocessed concurrently when loading the dataset,
+        # and whether they are decoded on a process pool rather than a thread pool
+        self.load_workers = 8
+        self.load_processes = False
+        # For datasets that do not fit in RAM: decode volumes on first use into an LRU cache
+        # of volume_cache_mb, and shuffle training slices volumes_per_group volumes at a time
+        self.lazy_volumes = False
+        self.volume_cache_mb = 2048
+        self.volumes_per_group = 8
+        # Data loading: number of worker processes (0 loads on the main process), whether
+        # workers survive between epochs, batches prefetched per worker and pinned host memory.
+        # persistent_workers and prefetch_factor need torch 1.7 or newer and are ignored before
+        self.num_workers = 4
+        self.persistent_workers = True
+        self.prefetch_factor = 2
+        self.pin_memory = True
+        # Training loss is logged to Tensorboard every log_scalar_interval batches,
+        # image grids every log_image_interval batches
+        self.log_scalar_interval = 10
+        self.log_image_interval = 50
+        # Render image grids as Matplotlib figures. If False, much cheaper pre-tiled images are written instead
+        self.log_images_as_figures = True
+        # Number of CPU processes the test set is evaluated on. 1 evaluates on the training device
+        self.test_workers = 1
+        # Test volumes are predicted test_batch_size slices per forward pass, so that memory
+        # use does not grow with the size of the volume. None predicts whole volumes at once
+        self.test_batch_size = 16
+        # Mixed precision: None for full float32, "bfloat16" (CPU or CUDA) or "float16" (CUDA only).
+        # Needs torch 1.10 or newer
+        self.autocast_dtype = None
+        # Use channels-last memory format for the convolutions. Needs torch 1.5 or newer
+        self.channels_last = False
+        # Randomly flip, rotate, deform and jitter training batches on the training device.
+        # The seed makes augmentations reproducible, None seeds randomly
+        self.augment = False
+        self.augmentation_seed = 0
+        # Number of CPU processes to train with DistributedDataParallel over the gloo backend.
+        # 1 trains in this process on the best available device. The processes rendezvous on
+        # master_port of this machine
+        self.world_size = 1
+        self.master_port = 29500
 
 if __name__ == "__main__":
     # Get configuration
@@ -31,7 +75,9 @@ if __name__ == "__main__":
     print("Loading data...")
 
     # TASK: LoadHippocampusData is not complete. Go to the implementation and complete it. 
-    data = LoadHippocampusData(c.root_dir, y_shape = c.patch_size, z_shape = c.patch_size)
+    data = LoadHippocampusData(c.root_dir, y_shape = c.patch_size, z_shape = c.patch_size, cache_dir = c.cache_dir,
+                               workers = c.load_workers, use_processes = c.load_processes,
+                               lazy = c.lazy_volumes, lazy_cache_bytes = c.volume_cache_mb * 2**20)
 
 
     # Create test-train-val split
@@ -56,7 +102,14 @@ if __name__ == "__main__":
     split["test"] = test_keys
 
     # Set up and run experiment
-    
+
+    # Distributed training runs the whole experiment, testing included, in its own processes.
+    # They load the dataset themselves, from the cache that loading it above has filled
+    if c.world_size > 1:
+        out_dir = run_distributed(c, split)
+        print(f"Results written to {out_dir}")
+        sys.exit()
+
     # TASK: Class UNetExperiment has missing pieces. Go to the file and fill them in
     exp = UNetExperiment(c, split, data)
 
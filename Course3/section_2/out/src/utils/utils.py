@@ -1,9 +1,13 @@
 """
 Various utility methods in this module
 """
+import queue
+import threading
+
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib as mpl
+from matplotlib.figure import Figure
 import torch
 from PIL import Image
 
@@ -20,32 +24,84 @@ def mpl_image_grid(images):
     Returns:
         Matplotlib figure
     """
-    # Create a figure to contain the plot.
+    # Create a figure to contain the plot. The figure is built through the object
+    # oriented API rather than pyplot, since pyplot keeps global state (current
+    # figure and axes) that is not safe to use from several logger threads at once
     n = min(images.shape[0], 16) # no more than 16 thumbnails
     rows = 4
     cols = (n // 4) + (1 if (n % 4) != 0 else 0)
-    figure = plt.figure(figsize=(2*rows, 2*cols))
-    plt.subplots_adjust(0, 0, 1, 1, 0.001, 0.001)
+    figure = Figure(figsize=(2*rows, 2*cols))
+    figure.subplots_adjust(0, 0, 1, 1, 0.001, 0.001)
+    if images.shape[1] == 3:
+        prob_maps = probability_map(images[:n])
     for i in range(n):
         # Start next subplot.
-        plt.subplot(cols, rows, i + 1)
-        plt.xticks([])
-        plt.yticks([])
-        plt.grid(False)
+        ax = figure.add_subplot(cols, rows, i + 1)
+        ax.set_xticks([])
+        ax.set_yticks([])
+        ax.grid(False)
         if images.shape[1] == 3:
-            # this is specifically for 3 softmax'd classes with 0 being bg
-            # We are building a probability map from our three classes using 
-            # fractional probabilities contained in the mask
-            vol = images[i].detach().numpy()
-            img = [[[(1-vol[0,x,y])*vol[1,x,y], (1-vol[0,x,y])*vol[2,x,y], 0] \
-                            for y in range(vol.shape[2])] \
-                            for x in range(vol.shape[1])]
-            plt.imshow(img)
+            ax.imshow(prob_maps[i])
         else: # plotting only 1st channel
-            plt.imshow((images[i, 0]*255).int(), cmap= "gray")
+            ax.imshow((images[i, 0]*255).int(), cmap= "gray")
 
     return figure
 
+def probability_map(images):
+    """
+    Builds RGB probability maps from softmax'd predictions
+
+    Arguments:
+        images {Torch tensor} -- Nx3xWxH array of softmax'd predictions
+
+    Returns:
+        NxWxHx3 Numpy array
+    """
+    # this is specifically for 3 softmax'd classes with 0 being bg
+    # We are building a probability map from our three classes using
+    # fractional probabilities contained in the mask: red and green channels
+    # hold the probabilities of the two foreground classes, scaled by the
+    # probability of not being background
+    vol = images.detach().numpy()
+    fg = 1 - vol[:, 0]
+    img = np.zeros(vol.shape[:1] + vol.shape[2:] + (3,), dtype=vol.dtype)
+    img[..., 0] = fg * vol[:, 1]
+    img[..., 1] = fg * vol[:, 2]
+
+    return img
+
+def image_grid(images):
+    """
+    Tiles up to 16 images into a single uint8 RGB image, 4 images per row,
+    laid out the same way as mpl_image_grid. Much cheaper than rendering a
+    figure, and can be written with SummaryWriter.add_image
+
+    Arguments:
+        images {Torch tensor} -- NxCxWxH array of images
+
+    Returns:
+        3x(ROWS*W)x(4*H) Numpy array of uint8
+    """
+    n = min(images.shape[0], 16) # no more than 16 thumbnails
+    if images.shape[1] == 3:
+        tiles = probability_map(images[:n])
+    else:
+        # Like imshow, scale every image to its own range of values
+        tiles = images[:n, 0].detach().float().numpy()
+        low = tiles.min(axis=(1, 2), keepdims=True)
+        high = tiles.max(axis=(1, 2), keepdims=True)
+        tiles = (tiles - low) / np.maximum(high - low, 1e-8)
+        tiles = np.repeat(tiles[..., None], 3, axis=-1)
+
+    cols = 4
+    rows = (n // 4) + (1 if (n % 4) != 0 else 0)
+    _, w, h, _ = tiles.shape
+    grid = np.zeros((rows * cols, w, h, 3), dtype=np.uint8)
+    grid[:n] = np.clip(tiles * 255, 0, 255).astype(np.uint8)
+
+    # [ROWS*COLS, W, H, 3] -> [3, ROWS*W, COLS*H]
+    return grid.reshape(rows, cols, w, h, 3).transpose(4, 0, 2, 1, 3).reshape(3, rows * w, cols * h)
+
 def log_to_tensorboard(writer, loss, data, target, prediction_softmax, prediction, counter):
     """Logs data to Tensorboard
 
@@ -60,14 +116,96 @@ def log_to_tensorboard(writer, loss, data, target, prediction_softmax, predictio
     """
     writer.add_scalar("Loss",\
                     loss, counter)
-    writer.add_figure("Image Data",\
-        mpl_image_grid(data.float().cpu()), global_step=counter)
-    writer.add_figure("Mask",\
-        mpl_image_grid(target.float().cpu()), global_step=counter)
-    writer.add_figure("Probability map",\
-        mpl_image_grid(prediction_softmax.cpu()), global_step=counter)
-    writer.add_figure("Prediction",\
-        mpl_image_grid(torch.argmax(prediction.cpu(), dim=1, keepdim=True)), global_step=counter)
+    log_images_to_tensorboard(writer, data, target, prediction_softmax, prediction, counter)
+
+def log_images_to_tensorboard(writer, data, target, prediction_softmax, prediction, counter, as_figures=True):
+    """Logs image grids to Tensorboard
+
+    Arguments:
+        writer {SummaryWriter} -- PyTorch Tensorboard wrapper to use for logging
+        data {tensor} -- image data
+        target {tensor} -- ground truth label
+        prediction_softmax {tensor} -- softmax'd prediction
+        prediction {tensor} -- raw prediction (to be used in argmax)
+        counter {int} -- batch and epoch counter
+        as_figures {bool} -- render Matplotlib figures, or write pre-tiled images if False
+    """
+    grids = {
+        "Image Data": data.float().cpu(),
+        "Mask": target.float().cpu(),
+        "Probability map": prediction_softmax.cpu(),
+        "Prediction": torch.argmax(prediction.cpu(), dim=1, keepdim=True)}
+
+    for tag, images in grids.items():
+        if as_figures:
+            writer.add_figure(tag, mpl_image_grid(images), global_step=counter)
+        else:
+            writer.add_image(tag, image_grid(images), global_step=counter)
+
+class AsyncTensorboardLogger:
+    """
+    Logs to Tensorboard without stalling the caller. Image grids are rendered
+    and written on a background thread from CPU snapshots of the tensors.
+    The queue of pending images is bounded: if rendering can not keep up,
+    new images are dropped rather than making the caller wait
+    """
+    def __init__(self, writer, max_queue_size=4, as_figures=True):
+        self.writer = writer
+        self.as_figures = as_figures
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def log_scalar(self, tag, value, counter):
+        """
+        Logs a scalar. SummaryWriter only queues the event, so this is cheap
+        and done right away
+
+        Arguments:
+            tag {string} -- name of the scalar
+            value {float} -- value to log
+            counter {int} -- batch and epoch counter
+        """
+        self.writer.add_scalar(tag, value, counter)
+
+    def log_images(self, data, target, prediction_softmax, prediction, counter):
+        """
+        Queues image grids for logging, see log_images_to_tensorboard.
+        Only the images that end up in the grids are copied
+
+        Returns:
+            True if images were queued, False if they were dropped
+        """
+        # mpl_image_grid shows no more than 16 images. Reduced precision tensors
+        # are widened since Numpy can not represent bfloat16
+        snapshot = [t[:16].detach().float().to("cpu", copy=True) for t in (data, target, prediction_softmax, prediction)]
+
+        try:
+            self.queue.put_nowait((snapshot, counter))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self):
+        """
+        Waits for queued images to be written and flushes the writer
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.flush()
+        if self.dropped:
+            print(f"Dropped {self.dropped} Tensorboard image updates")
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            snapshot, counter = item
+            log_images_to_tensorboard(self.writer, *snapshot, counter, as_figures=self.as_figures)
 
 def save_numpy_as_image(arr, path):
     """
@@ -80,22 +218,103 @@ def save_numpy_as_image(arr, path):
     plt.imshow(arr, cmap="gray") #Needs to be in row,col order
     plt.savefig(path)
 
-def med_reshape(image, new_shape):
+def med_reshape(image, new_shape, mode="pad", out=None, dtype=None):
     """
-    This function reshapes 3D data to new dimension padding with zeros
-    and leaving the content in the top-left corner
+    This function reshapes 3D data to new dimension padding with zeros.
+    Only the padding is zeroed, the content is copied once straight into its place
 
     Arguments:
         image {array} -- 3D array of pixel data
         new_shape {3-tuple} -- expected output shape
+        mode {string} -- where the content goes:
+            "pad" - top-left corner, the image must fit into new_shape
+            "crop" - top-left corner, dimensions larger than new_shape are cropped at the end
+            "center" - centered, dimensions are padded or cropped evenly on both sides
+        out {array} -- optional preallocated array of new_shape to write into
+        dtype {Numpy dtype} -- dtype of the output, dtype of the image by default
 
     Returns:
         3D array of desired shape, padded with zeroes
     """
+    new_shape = tuple(new_shape)
+    if out is None:
+        out = np.empty(new_shape, dtype=image.dtype if dtype is None else dtype)
+    elif out.shape != new_shape:
+        raise ValueError(f"out has shape {out.shape}, expected {new_shape}")
 
-    reshaped_image = np.zeros(new_shape)
+    src, dst = _reshape_windows(image.shape, new_shape, mode)
+
+    # Zero whatever is left around the content, one slab per side of every dimension
+    for axis, (start, stop) in enumerate(dst):
+        lead = (slice(None),) * axis
+        out[lead + (slice(0, start),)] = 0
+        out[lead + (slice(stop, None),)] = 0
 
     # TASK: write your original image into the reshaped image
-    reshaped_image[:image.shape[0], :image.shape[1], :image.shape[2]] = image
+    out[tuple(slice(start, stop) for start, stop in dst)] = image[tuple(slice(start, stop) for start, stop in src)]
+
+    return out
+
+def med_reshape_batch(images, new_shape, mode="pad", out=None, dtype=None):
+    """
+    Reshapes the Y and Z dimensions of many 3D volumes and stacks the results along X
+    into a single contiguous array, so that every slice of every volume sits in one block
+
+    Arguments:
+        images {list of arrays} -- 3D arrays of pixel data, of any X size
+        new_shape {2-tuple} -- expected Y and Z sizes
+        mode {string} -- see med_reshape
+        out {array} -- optional preallocated array of shape [total X, Y, Z] to write into
+        dtype {Numpy dtype} -- dtype of the output, dtype of the first image by default
+
+    Returns:
+        tuple of (3D array of all reshaped volumes, array of offsets where volume i
+        occupies rows offsets[i]:offsets[i+1])
+    """
+    offsets = np.zeros(len(images) + 1, dtype=np.int64)
+    np.cumsum([image.shape[0] for image in images], out=offsets[1:])
+
+    shape = (int(offsets[-1]),) + tuple(new_shape)
+    if out is None:
+        out = np.empty(shape, dtype=images[0].dtype if dtype is None else dtype)
+    elif out.shape != shape:
+        raise ValueError(f"out has shape {out.shape}, expected {shape}")
+
+    # Each volume is reshaped straight into its rows of the block
+    for image, start, stop in zip(images, offsets[:-1], offsets[1:]):
+        med_reshape(image, (image.shape[0],) + shape[1:], mode=mode, out=out[start:stop])
+
+    return out, offsets
+
+def _reshape_windows(shape, new_shape, mode):
+    """
+    Computes which part of the image goes where in the reshaped image
+
+    Arguments:
+        shape {tuple} -- shape of the image
+        new_shape {tuple} -- shape of the reshaped image
+        mode {string} -- see med_reshape
+
+    Returns:
+        tuple of (list of (start, stop) in the image, list of (start, stop) in the reshaped image)
+        for every dimension
+    """
+    if mode not in ("pad", "crop", "center"):
+        raise ValueError(f"Unknown reshape mode {mode}")
+
+    if mode == "pad" and any(size > new_size for size, new_size in zip(shape, new_shape)):
+        raise ValueError(f"Image of shape {tuple(shape)} does not fit into {new_shape}, use mode='crop' or 'center'")
+
+    src, dst = [], []
+    for size, new_size in zip(shape, new_shape):
+        length = min(size, new_size)
+        # Centering splits the difference evenly, with the odd voxel going to the end
+        offset = abs(new_size - size) // 2 if mode == "center" else 0
+        if size > new_size:
+            src.append((offset, offset + length))
+            dst.append((0, length))
+        else:
+            src.append((0, length))
+            dst.append((offset, offset + length))
 
-    return reshaped_image
+    return src, dst
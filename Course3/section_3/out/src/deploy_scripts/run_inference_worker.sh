@@ -0,0 +1,4 @@
+#!/bin/sh
+
+cd ..
+python inference_dcm.py ../route --watch
@@ -0,0 +1,98 @@
+"""
+Here we send DICOM datasets to the clinical archive with C-STORE requests, from within
+the inference process. Compared to running storescu for every report, we skip the shell
+and process startup, keep one association open across reports, and learn from the
+C-STORE response whether the archive actually stored the report.
+
+The archive can be stood in for by any storescp, e.g. the one started by
+deploy_scripts/start_listener.sh, or by a pynetdicom AE as in run_benchmarks.py
+"""
+import threading
+
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+from pynetdicom import AE
+
+# SOP Class UID of Secondary Capture Image Storage, which is what our reports are
+SECONDARY_CAPTURE_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.7"
+
+# C-STORE statuses that mean the dataset was stored: success, and warnings about
+# coercion of data elements, elements discarded and dataset not matching SOP class
+STORED_STATUSES = (0x0000, 0xB000, 0xB006, 0xB007)
+
+class DicomSender:
+    """
+    Sends datasets to a DICOM Storage SCP over an association that is opened on the
+    first send and reused by the following ones. An association that has been
+    aborted or released by the peer (e.g. due to its idle timeout) is reopened.
+    Sends are serialized, so a sender can be shared between threads
+    """
+    def __init__(self, address="127.0.0.1", port=4242, ae_title="HIPPOAI", calling_ae_title="HIPPOVOLUME",
+                 sop_classes=(SECONDARY_CAPTURE_IMAGE_STORAGE,), timeout=30):
+        self.address = address
+        self.port = port
+        self.ae_title = ae_title
+
+        self.ae = AE(ae_title=calling_ae_title)
+        for sop_class in sop_classes:
+            self.ae.add_requested_context(sop_class, [ExplicitVRLittleEndian, ImplicitVRLittleEndian])
+        self.ae.acse_timeout = timeout
+        self.ae.dimse_timeout = timeout
+        self.ae.network_timeout = timeout
+
+        self.association = None
+        self.lock = threading.Lock()
+
+    def send(self, dataset):
+        """
+        Sends a dataset with a C-STORE request and waits for the response
+
+        Arguments:
+            dataset {PyDicom Dataset} -- dataset to store, with SOPClassUID among sop_classes
+
+        Returns:
+            C-STORE response status
+        """
+        with self.lock:
+            # An association that looks established may still have been closed by the peer
+            # since the last send, which only shows as an empty response. We reconnect and
+            # try once more in that case
+            for attempt in range(2):
+                status = self._get_association().send_c_store(dataset)
+                if status:
+                    break
+                self._close_association()
+            else:
+                raise ConnectionError(f"No C-STORE response from {self.ae_title}@{self.address}:{self.port}")
+
+        if status.Status not in STORED_STATUSES:
+            raise RuntimeError(f"{self.ae_title} refused to store {dataset.SOPInstanceUID}: "
+                               f"status 0x{status.Status:04X}")
+
+        return status.Status
+
+    def close(self):
+        """
+        Releases the association, if one is open
+        """
+        with self.lock:
+            self._close_association()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _get_association(self):
+        if self.association is None or not self.association.is_established:
+            self.association = self.ae.associate(self.address, self.port, ae_title=self.ae_title)
+            if not self.association.is_established:
+                self.association = None
+                raise ConnectionError(f"Could not associate with {self.ae_title}@{self.address}:{self.port}")
+
+        return self.association
+
+    def _close_association(self):
+        if self.association is not None and self.association.is_established:
+            self.association.release()
+        self.association = None
@@ -0,0 +1,78 @@
+"""
+Here we export trained model parameters into a form that is faster to load and run
+in deployment than the eager PyTorch model:
+    * a frozen TorchScript module (.pt)
+    * an ONNX graph (.onnx) with dynamic batch and spatial axes, to be run with ONNX Runtime
+
+UNetInferenceAgent loads either one when its parameter_file_path points to it.
+Usage:
+
+    python export_model.py ../model/model.pth ../model/model.pt
+    python export_model.py ../model/model.pth ../model/model.onnx
+"""
+import sys
+
+import torch
+
+from networks.RecursiveUNet import UNet
+
+def load_eager_model(parameter_file_path):
+    """Loads model parameters into the eager UNet on CPU
+
+    Arguments:
+        parameter_file_path {string} -- path to model.pth
+
+    Returns:
+        UNet in eval mode
+    """
+    model = UNet(num_classes=3)
+    model.load_state_dict(torch.load(parameter_file_path, map_location="cpu"))
+    return model.eval()
+
+def export_torchscript(model, path, patch_size=64):
+    """Traces the model into a frozen TorchScript module
+
+    Arguments:
+        model {torch.nn.Module} -- model in eval mode
+        path {string} -- where to save the module
+        patch_size {int} -- spatial size of the example input used for tracing
+    """
+    example = torch.zeros(1, 1, patch_size, patch_size)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        # Freezing inlines parameters as constants and lets the JIT fold them into the graph.
+        # It needs torch 1.8 or newer, older versions save the traced module as is
+        if hasattr(torch.jit, "freeze"):
+            traced = torch.jit.freeze(traced)
+
+    torch.jit.save(traced, path)
+
+def export_onnx(model, path, patch_size=64):
+    """Exports the model into an ONNX graph with dynamic batch and spatial axes
+
+    Arguments:
+        model {torch.nn.Module} -- model in eval mode
+        path {string} -- where to save the graph
+        patch_size {int} -- spatial size of the example input used for tracing
+    """
+    example = torch.zeros(1, 1, patch_size, patch_size)
+    dynamic_axes = {0: "batch", 2: "height", 3: "width"}
+    with torch.no_grad():
+        torch.onnx.export(model, example, path,
+                          input_names=["slices"], output_names=["logits"],
+                          dynamic_axes={"slices": dynamic_axes, "logits": dynamic_axes},
+                          opset_version=11)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or not sys.argv[2].endswith((".pt", ".onnx")):
+        print("You should supply the path to model.pth and the output path ending with .pt or .onnx. Exiting.")
+        sys.exit()
+
+    model = load_eager_model(sys.argv[1])
+
+    if sys.argv[2].endswith(".pt"):
+        export_torchscript(model, sys.argv[2])
+    else:
+        export_onnx(model, sys.argv[2])
+
+    print(f"Exported {sys.argv[1]} to {sys.argv[2]}")
@@ -0,0 +1,132 @@
+"""
+Contains class that caches predictions on disk, so that studies that get routed
+to us more than once do not have to go through inference again
+"""
+import os
+import json
+import hashlib
+import zipfile
+
+import numpy as np
+
+def file_hash(path, chunk_size=2**20):
+    """Computes SHA-1 of a file's content, reading it in chunks
+
+    Arguments:
+        path {string} -- file to hash
+        chunk_size {int} -- bytes read at a time
+
+    Returns:
+        hex digest string
+    """
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+class PredictionCache:
+    """
+    Persistent cache of predicted label volumes and their measured structure volumes.
+    Entries are keyed by SeriesInstanceUID, a hash of the pixel data and a hash of the
+    model weights, so a resent series is only served from the cache if neither the
+    images nor the model have changed since. Each entry is a single .npz file, and
+    the least recently used entries are evicted once the cache grows above max_bytes
+    """
+    def __init__(self, cache_dir, model_hash, max_bytes=2**30):
+        self.cache_dir = cache_dir
+        self.model_hash = model_hash
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, series_uid, volume):
+        """
+        Computes the cache key of a series
+
+        Arguments:
+            series_uid {string} -- SeriesInstanceUID of the series
+            volume {Numpy array} -- 3D volume assembled from the series
+
+        Returns:
+            hex digest string
+        """
+        sha = hashlib.sha1()
+        sha.update(f"{series_uid}|{volume.shape}|{volume.dtype.str}|{self.model_hash}|".encode())
+        sha.update(np.ascontiguousarray(volume).data)
+        return sha.hexdigest()
+
+    def get(self, key):
+        """
+        Looks up an entry and marks it as recently used
+
+        Arguments:
+            key {string} -- key computed by key()
+
+        Returns:
+            tuple of (predicted label volume, dictionary of structure volumes) or None
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as entry:
+                pred_label = entry["label"]
+                pred_volumes = json.loads(str(entry["volumes"]))
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            # Missing entries, and entries that got evicted or damaged while we read them
+            self.misses += 1
+            return None
+
+        # File modification time tells the eviction which entries were used last
+        os.utime(path)
+        self.hits += 1
+        return pred_label, pred_volumes
+
+    def put(self, key, pred_label, pred_volumes):
+        """
+        Stores an entry, then evicts least recently used entries above the size limit
+
+        Arguments:
+            key {string} -- key computed by key()
+            pred_label {Numpy array} -- predicted label volume
+            pred_volumes {dictionary} -- output of get_predicted_volumes
+        """
+        # Labels are 0, 1 and 2, so they fit into a byte and compress very well.
+        # The entry is written next to its final place and renamed, so that readers
+        # never see a half written file
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, label=pred_label.astype(np.uint8),
+                                volumes=json.dumps({k: int(v) for k, v in pred_volumes.items()}))
+        os.replace(tmp_path, self._path(key))
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits into max_bytes
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npz"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
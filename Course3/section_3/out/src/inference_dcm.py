@@ -7,7 +7,10 @@ This code will do the following:
     2. Construct a NumPy volume from a set of DICOM files
     3. Run inference on the constructed volume
     4. Create report from the inference
-    5. Call a shell script to push report to the storage archive
+    5. Send the report to the storage archive with a C-STORE request (see DicomSender)
+
+Run with --watch to keep the model loaded and process studies continuously as they
+get routed, instead of processing the latest study and exiting
 """
 
 import os
@@ -15,7 +18,11 @@ import sys
 import datetime
 import time
 import shutil
-import subprocess
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -26,30 +33,117 @@ from PIL import ImageFont
 from PIL import ImageDraw
 
 from inference.UNetInferenceAgent import UNetInferenceAgent
+from inference.PredictionCache import PredictionCache, file_hash
+from dicom_sender import DicomSender, SECONDARY_CAPTURE_IMAGE_STORAGE
+
+# DICOM elements larger than this (in bytes) are not read until accessed
+DEFER_SIZE = 1024
+
+# Series description of the reports we create. Orthanc routes every instance it
+# stores, our own reports included, so this is how we recognize them coming back
+REPORT_SERIES_DESCRIPTION = "HippoVolume.AI"
+
+@lru_cache(maxsize=None)
+def get_font(size):
+    """Loads the report font once per size and keeps it for later reports
+
+    Arguments:
+        size {int} -- font size
+
+    Returns:
+        PIL font
+    """
+    return ImageFont.truetype("assets/Roboto-Regular.ttf", size=size)
+
+@lru_cache(maxsize=None)
+def get_colormap_lut(name):
+    """Evaluates a Matplotlib colormap once at all 256 uint8 levels
+
+    Arguments:
+        name {string} -- Matplotlib colormap name
+
+    Returns:
+        256x3 uint8 Numpy array of RGB colors, indexed by level
+    """
+    # Integer input indexes the colormap directly, the same way as calling
+    # the colormap on a uint8 image does
+    return (plt.get_cmap(name)(np.arange(256))[:, :3] * 255).astype(np.uint8)
+
+def get_pixel_dtype(dcm):
+    """Figures out the NumPy dtype of stored pixel values from the DICOM header
+
+    Arguments:
+        dcm {PyDicom object} -- DICOM header
+
+    Returns:
+        NumPy dtype
+    """
+    kind = "i" if dcm.PixelRepresentation == 1 else "u"
+    byteorder = "<" if dcm.is_little_endian else ">"
+    return np.dtype(f"{byteorder}{kind}{dcm.BitsAllocated // 8}")
 
-def load_dicom_volume_as_numpy_from_list(dcmlist):
+def has_raw_pixels(dcm):
+    """Checks whether the pixel data of a DICOM image can be used as stored, without
+    going through PyDicom's pixel_array. This is the case for uncompressed, single
+    sample images with whole byte pixels that use all of their allocated bits
+
+    Arguments:
+        dcm {PyDicom object} -- DICOM image
+
+    Returns:
+        True if pixels can be read straight from the PixelData bytes
+    """
+    return (not dcm.file_meta.TransferSyntaxUID.is_compressed
+            and dcm.SamplesPerPixel == 1
+            and dcm.BitsAllocated in (8, 16, 32)
+            and dcm.BitsStored == dcm.BitsAllocated)
+
+def load_dicom_volume_as_numpy_from_list(dcmlist, max_workers=8):
     """Loads a list of PyDicom objects a Numpy array.
     Assumes that only one series is in the array
 
     Arguments:
         dcmlist {list of PyDicom objects} -- path to directory
+        max_workers {int} -- number of threads used to decode the slices
 
     Returns:
         tuple of (3D volume, header of the 1st image)
     """
 
     # In the real world you would do a lot of validation here
-    slices = [np.flip(dcm.pixel_array).T for dcm in sorted(dcmlist, key=lambda dcm: dcm.InstanceNumber)]
+    # We only sort slice positions by InstanceNumber and allocate the whole volume once.
+    # Every slice is then flipped, transposed and written straight into its place in the
+    # volume, so there are no intermediate per-slice copies to stack afterwards
+    order = sorted(range(len(dcmlist)), key=lambda i: dcmlist[i].InstanceNumber)
+    hdr = dcmlist[0]
+    # Anything other than raw pixels (compressed data, 1 or 12 bit pixels, signed values in
+    # fewer bits than allocated) is decoded by PyDicom, which also picks the dtype
+    dtype = get_pixel_dtype(hdr).newbyteorder("=") if has_raw_pixels(hdr) else hdr.pixel_array.dtype
+    volume = np.empty((hdr.Columns, hdr.Rows, len(dcmlist)), dtype=dtype)
+
+    def decode_slice(position):
+        dcm = dcmlist[order[position]]
+        if has_raw_pixels(dcm):
+            # Uncompressed pixel data can be viewed in place without decoding. PixelData
+            # is padded to an even length, so only the pixels themselves are taken
+            pixels = np.frombuffer(dcm.PixelData, dtype=get_pixel_dtype(dcm),
+                                   count=dcm.Rows * dcm.Columns).reshape(dcm.Rows, dcm.Columns)
+        else:
+            pixels = dcm.pixel_array
+        volume[:, :, position] = np.flip(pixels).T
+
+    # Reading deferred pixel data is mostly waiting on disk, so we do it from a thread pool
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(decode_slice, range(len(dcmlist))))
 
     # Make sure that you have correctly constructed the volume from your axial slices!
-    hdr = dcmlist[0]
 
     # We return header so that we can inspect metadata properly.
     # Since for our purposes we are interested in "Series" header, we grab header of the
     # first file (assuming that any instance-specific values will be ighored - common approach)
     # We also zero-out Pixel Data since the users of this function are only interested in metadata
     hdr.PixelData = None
-    return (np.stack(slices, 2), hdr)
+    return (volume, hdr)
 
 def get_predicted_volumes(pred):
     """Gets volumes of two hippocampal structures from the predicted array
@@ -90,8 +184,8 @@ def create_report(inference, header, orig_vol, pred_vol):
     pimg = Image.new("RGB", (1000, 1000))
     draw = ImageDraw.Draw(pimg)
 
-    header_font = ImageFont.truetype("assets/Roboto-Regular.ttf", size=40)
-    main_font = ImageFont.truetype("assets/Roboto-Regular.ttf", size=20)
+    header_font = get_font(40)
+    main_font = get_font(20)
 
     slice_nums = [orig_vol.shape[2]//3, orig_vol.shape[2]//2, orig_vol.shape[2]*3//4] # is there a better choice?
 
@@ -138,9 +232,10 @@ def create_report(inference, header, orig_vol, pred_vol):
     y_offset = 450
     color1 = "Greys"
     color2 = "Reds"
-    pimg.paste(get_overlaid_image(orig_vol[:, :, slice_nums[0]], pred_vol[:, :, slice_nums[0]], size=size, color1=color1, color2=color2), box=(x_offset, y_offset))
-    pimg.paste(get_overlaid_image(orig_vol[:, :, slice_nums[1]], pred_vol[:, :, slice_nums[1]], size=size, color1=color1, color2=color2), box=(x_offset + size[0] + x_padding, y_offset))
-    pimg.paste(get_overlaid_image(orig_vol[:, :, slice_nums[2]], pred_vol[:, :, slice_nums[2]], size=size, color1=color1, color2=color2), box=(x_offset + 2 * (size[0] + x_padding), y_offset))
+    # All three overlays are colored and blended in one pass over the selected slices
+    overlays = get_overlaid_images(orig_vol[:, :, slice_nums], pred_vol[:, :, slice_nums], size=size, color1=color1, color2=color2)
+    for i, overlay in enumerate(overlays):
+        pimg.paste(overlay, box=(x_offset + i * (size[0] + x_padding), y_offset))
 
     return pimg
 
@@ -154,25 +249,36 @@ def get_overlaid_image(slice, mask, size, color1, color2):
     Returns:
         PIL image
     """
+    return get_overlaid_images(slice[:, :, np.newaxis], mask[:, :, np.newaxis], size, color1, color2)[0]
+
+def get_overlaid_images(slices, masks, size, color1, color2):
+    """Creates overlays of masks on top of original slices
+
+    Arguments:
+        slices {Numpy array} -- original slices stacked along the last axis
+        masks {Numpy array} -- predicted masks stacked along the last axis
+        size {tuple} -- size of every overlay image
+        color1 {string} -- Matplotlib colormap of the slices
+        color2 {string} -- Matplotlib colormap of the masks
 
-    # Load the original slice
-    slice = np.flip((slice / np.max(slice)) * 0xff).T.astype(np.uint8)
-    colormap = plt.get_cmap(color1)
-    colored_slice = colormap(slice)
-    colored_slice = (colored_slice[:, :, :3] * 255).astype(np.uint8)  # Drop the alpha channel and scale to 0-255
-    pil_i = Image.fromarray(colored_slice).resize(size)
-
-    # Load the mask
-    mask = np.flip((mask / np.max(mask)) * 0xff).T.astype(np.uint8)
-    mask_colormap = plt.get_cmap(color2)
-    colored_mask = mask_colormap(mask)
-    colored_mask = (colored_mask[:, :, :3] * 255).astype(np.uint8)  # Drop the alpha channel and scale to 0-255
-    mask_pil = Image.fromarray(colored_mask).resize(size)
-    
-    # Create an overlay by blending the original slice and the mask
-    overlay = Image.blend(pil_i, mask_pil, alpha=0.5)
-    
-    return overlay
+    Returns:
+        list of PIL images
+    """
+    # Normalize every slice and mask to [0..255] by its own maximum, then flip and
+    # transpose them all at once into [N, height, width] images
+    slices = np.moveaxis(slices, -1, 0)
+    masks = np.moveaxis(masks, -1, 0)
+    slices = np.flip((slices / np.max(slices, axis=(1, 2), keepdims=True)) * 0xff, axis=(1, 2)).astype(np.uint8)
+    masks = np.flip((masks / np.max(masks, axis=(1, 2), keepdims=True)) * 0xff, axis=(1, 2)).astype(np.uint8)
+    slices = slices.transpose(0, 2, 1)
+    masks = masks.transpose(0, 2, 1)
+
+    # Color both through precomputed lookup tables and blend them half and half,
+    # in integers. The blend is done before resizing, so each overlay is resized once
+    colored = get_colormap_lut(color1)[slices].astype(np.uint16) + get_colormap_lut(color2)[masks]
+    blended = (colored >> 1).astype(np.uint8)
+
+    return [Image.fromarray(overlay).resize(size) for overlay in blended]
 
 def save_report_as_dcm(header, report, path):
     """Writes the supplied image as a DICOM Secondary Capture file
@@ -185,6 +291,18 @@ def save_report_as_dcm(header, report, path):
     Returns:
         N/A
     """
+    pydicom.filewriter.dcmwrite(path, create_report_dcm(header, report), write_like_original=False)
+
+def create_report_dcm(header, report):
+    """Builds a DICOM Secondary Capture dataset from the supplied image
+
+    Arguments:
+        header {PyDicom Dataset} -- original DICOM file header
+        report {PIL image} -- image representing the report
+
+    Returns:
+        PyDicom Dataset
+    """
 
     # Code below creates a DICOM Secondary Capture instance that will be correctly
     # interpreted by most imaging viewers including our OHIF
@@ -213,7 +331,7 @@ def save_report_as_dcm(header, report, path):
     out.is_implicit_VR = False
 
     # We need to change class to Secondary Capture
-    out.SOPClassUID = "1.2.840.10008.5.1.4.1.1.7"
+    out.SOPClassUID = SECONDARY_CAPTURE_IMAGE_STORAGE
     out.file_meta.MediaStorageSOPClassUID = out.SOPClassUID
 
     # Our report is a separate image series of one image
@@ -221,7 +339,7 @@ def save_report_as_dcm(header, report, path):
     out.SOPInstanceUID = pydicom.uid.generate_uid()
     out.file_meta.MediaStorageSOPInstanceUID = out.SOPInstanceUID
     out.Modality = "OT" # Other
-    out.SeriesDescription = "HippoVolume.AI"
+    out.SeriesDescription = REPORT_SERIES_DESCRIPTION
 
     out.Rows = report.height
     out.Columns = report.width
@@ -254,14 +372,27 @@ def save_report_as_dcm(header, report, path):
 
     out.PixelData = report.tobytes()
 
-    pydicom.filewriter.dcmwrite(path, out, write_like_original=False)
+    return out
+
+def read_dicom_header(path):
+    """Reads a DICOM file without loading its pixel data. Large elements
+    (Pixel Data in particular) are deferred and only read from disk when accessed
 
-def get_series_for_inference(path):
+    Arguments:
+        path {string} -- path to the DICOM file
+
+    Returns:
+        PyDicom Dataset
+    """
+    return pydicom.dcmread(path, defer_size=DEFER_SIZE)
+
+def get_series_for_inference(path, max_workers=8):
     """Reads multiple series from one folder and picks the one
     to run inference on.
 
     Arguments:
         path {string} -- location of the DICOM files
+        max_workers {int} -- number of threads used to read the headers
 
     Returns:
         Numpy array representing the series
@@ -269,8 +400,15 @@ def get_series_for_inference(path):
 
     # Here we are assuming that path is a directory that contains a full study as a collection
     # of files
-    # We are reading all files into a list of PyDicom objects so that we can filter them later
-    dicoms = [pydicom.dcmread(os.path.join(path, f)) for f in os.listdir(path)]
+    # We are reading headers of all files into a list of PyDicom objects so that we can filter
+    # them later. Pixel data is deferred, so it is only ever read for the files of the series
+    # we pick. Reading is mostly waiting on disk, so we fan it out over a thread pool
+    files = [os.path.join(path, f) for f in os.listdir(path)]
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        dicoms = list(pool.map(read_dicom_header, files))
+    elapsed = time.time() - start
 
     # TASK: create a series_for_inference variable that will contain a list of only 
     # those PyDicom objects that represent files that belong to the series that you 
@@ -283,6 +421,13 @@ def get_series_for_inference(path):
     # certain way. Can you figure out which is that? 
     # Hint: inspect the metadata of HippoCrop series
     series_for_inference = [dcm for dcm in dicoms if dcm.SeriesDescription == "HippoCrop"]
+
+    # Files of the other series are never read past their headers. Their sizes on disk
+    # are what we avoided reading
+    skipped = sum(os.path.getsize(dcm.filename) for dcm in dicoms if dcm.SeriesDescription != "HippoCrop")
+    print(f"Scanned {len(files)} files in {elapsed:.2f}s ({len(files) / max(elapsed, 1e-6):.1f} files/sec),",
+          f"skipped reading {skipped / 2**20:.1f} MB of files from other series")
+
     if not series_for_inference:
         print("No valid series found.")
         return []
@@ -294,82 +439,282 @@ def get_series_for_inference(path):
 
     return series_for_inference
 
-def os_command(command):
-    # Comment this if running under Windows
-    sp = subprocess.Popen(["/bin/bash", "-i", "-c", command])
-    sp.communicate()
+def is_report_only(study_dir):
+    """Checks whether a study directory holds nothing but our own reports.
+    Orthanc routes the reports we send back to us, which recreates the study
+    directory after it has been processed and removed
 
-    # Uncomment this if running under Windows
-    #os.system(command)
+    Arguments:
+        study_dir {string} -- directory containing one study
 
-if __name__ == "__main__":
-    # This code expects a single command line argument with link to the directory containing
-    # routed studies
-    if len(sys.argv) != 2:
-        print("You should supply one command line argument pointing to the routing folder. Exiting.")
-        sys.exit()
+    Returns:
+        True if every DICOM file in the directory is one of our reports
+    """
+    # The directory may be removed by the worker while we look at it
+    try:
+        files = [os.path.join(study_dir, f) for f in os.listdir(study_dir)]
+    except FileNotFoundError:
+        return False
+    if not files:
+        return False
+
+    for f in files:
+        try:
+            dcm = pydicom.dcmread(f, stop_before_pixels=True)
+        except (pydicom.errors.InvalidDicomError, OSError):
+            return False
+
+        # Any other file means there is a study to process, so a study from the
+        # scanner is recognized after reading a single header
+        if dcm.get("SOPClassUID") != SECONDARY_CAPTURE_IMAGE_STORAGE \
+                or dcm.get("SeriesDescription") != REPORT_SERIES_DESCRIPTION:
+            return False
+
+    return True
+
+def remove_report_only_study(study_dir):
+    """Removes a study directory if it holds nothing but our own reports,
+    see is_report_only
 
-    # Find all subdirectories within the supplied directory. We assume that 
-    # one subdirectory contains a full study
-    subdirs = [os.path.join(sys.argv[1], d) for d in os.listdir(sys.argv[1]) if
-                os.path.isdir(os.path.join(sys.argv[1], d))]
+    Arguments:
+        study_dir {string} -- directory containing one study
 
-    # Get the latest directory
-    study_dir = sorted(subdirs, key=lambda dir: os.stat(dir).st_mtime, reverse=True)[0]
+    Returns:
+        True if the directory was removed
+    """
+    if not is_report_only(study_dir):
+        return False
 
+    print(f"Removing {study_dir}, which only contains our own report")
+    shutil.rmtree(study_dir, onerror=lambda f, p, e: print(f"Error deleting: {e[1]}"))
+    return True
+
+def process_study(study_dir, inference_agent, report_sender, prediction_cache=None, report_save_path=None):
+    """Runs HippoVolume.AI on a single study directory: finds the series to run
+    inference on, runs inference, creates the report and pushes it to the archive.
+    The study directory is removed once the report has been sent
+
+    Arguments:
+        study_dir {string} -- directory containing one full study
+        inference_agent {UNetInferenceAgent} -- agent with loaded model
+        report_sender {DicomSender} -- sender connected to the storage archive
+        prediction_cache {PredictionCache} -- optional cache of earlier predictions
+        report_save_path {string} -- optional path to also write the report DICOM file to
+
+    Returns:
+        True if a series for inference was found and processed, False otherwise
+    """
     print(f"Looking for series to run inference on in directory {study_dir}...")
 
     # TASK: get_series_for_inference is not complete. Go and complete it
-    sorted_subdirs = sorted(subdirs, key=lambda dir: os.stat(dir).st_mtime, reverse=True)
-    for directory in sorted_subdirs:
-        print(f"Trying directory {directory}")
-        series_for_inference = get_series_for_inference(directory)
-        if series_for_inference: 
-            print(f"Found valid series.")
-            break
-
+    series_for_inference = get_series_for_inference(study_dir)
     if not series_for_inference:
-        print("Could not find series for inference.")
-        sys.exit()
+        return False
+
+    print(f"Found valid series.")
 
     volume, header = load_dicom_volume_as_numpy_from_list(series_for_inference)
     print(f"Found series of {volume.shape[2]} axial slices")
 
-    print("HippoVolume.AI: Running inference...")
-    # TASK: Use the UNetInferenceAgent class and model parameter file from the previous section
-    inference_agent = UNetInferenceAgent(
-        device="cpu",
-        parameter_file_path=r"../model/model.pth")
-
-    # Run inference
-    # TASK: single_volume_inference_unpadded takes a volume of arbitrary size 
-    # and reshapes y and z dimensions to the patch size used by the model before 
-    # running inference. Your job is to implement it.
-    pred_label = inference_agent.single_volume_inference_unpadded(np.array(volume))
-    # TASK: get_predicted_volumes is not complete. Go and complete it
-    pred_volumes = get_predicted_volumes(pred_label)
+    # Orthanc routes every series it stores, so the same series can come in again after
+    # a resend. If we have already seen these exact images with this model, we reuse
+    # the prediction and go straight to the report
+    cached = None
+    if prediction_cache is not None:
+        cache_key = prediction_cache.key(header.SeriesInstanceUID, volume)
+        cached = prediction_cache.get(cache_key)
+
+    if cached is not None:
+        print("HippoVolume.AI: Using cached prediction...")
+        pred_label, pred_volumes = cached
+    else:
+        print("HippoVolume.AI: Running inference...")
+
+        # Run inference
+        # single_volume_inference_unpadded takes a volume of arbitrary size, pads y and z
+        # dimensions up to the patch size used by the model if they are smaller and tiles
+        # them with overlapping patches if they are larger, so nothing gets truncated
+        pred_label = inference_agent.single_volume_inference_unpadded(np.array(volume))
+        # TASK: get_predicted_volumes is not complete. Go and complete it
+        pred_volumes = get_predicted_volumes(pred_label)
+
+        if prediction_cache is not None:
+            prediction_cache.put(cache_key, pred_label, pred_volumes)
 
     # Create and save the report
     print("Creating and pushing report...")
-    report_save_path = r"/home/workspace/out/report.dcm"
     # TASK: create_report is not complete. Go and complete it. 
-    # STAND OUT SUGGESTION: save_report_as_dcm has some suggestions if you want to expand your
+    # STAND OUT SUGGESTION: create_report_dcm has some suggestions if you want to expand your
     # knowledge of DICOM format
     report_img = create_report(pred_volumes, header, volume, pred_label)
-    save_report_as_dcm(header, report_img, report_save_path)
+    report_dcm = create_report_dcm(header, report_img)
+    if report_save_path:
+        pydicom.filewriter.dcmwrite(report_save_path, report_dcm, write_like_original=False)
 
     # Send report to our storage archive
-    # TASK: Write a command line string that will issue a DICOM C-STORE request to send our report
-    # to our Orthanc server (that runs on port 4242 of the local machine), using storescu tool
-    os_command(f"storescu 127.0.0.1 4242 -v -aec HIPPOAI +r +sd \"{report_save_path}\"")
+    # The report goes out from memory with a C-STORE request to our Orthanc server (that runs
+    # on port 4242 of the local machine), over an association the sender keeps open between
+    # studies. send() only returns once the archive has confirmed that it stored the report,
+    # so we do not have to wait before cleaning up
+    report_sender.send(report_dcm)
 
     # This line will remove the study dir if run as root user
-    # Sleep to let our StoreSCP server process the report (remember - in our setup
-    # the main archive is routing everyting that is sent to it, including our freshly generated
-    # report) - we want to give it time to save before cleaning it up
-    time.sleep(2)
     shutil.rmtree(study_dir, onerror=lambda f, p, e: print(f"Error deleting: {e[1]}"))
 
     print(f"Inference successful on {header['SOPInstanceUID'].value}, out: {pred_label.shape}",
           f"volume ant: {pred_volumes['anterior']}, ",
           f"volume post: {pred_volumes['posterior']}, total volume: {pred_volumes['total']}")
+    return True
+
+def watch_routing_folder(routing_dir, study_queue, poll_interval=2, settle_time=10, failed_queue=None, retry_interval=60):
+    """Polls the routing folder and queues studies that have stopped changing.
+    storescp writes every study into its own subdirectory (--sort-on-study-uid)
+    and gives no signal when a study is complete, so we consider a study
+    complete once its directory has not been modified for settle_time seconds.
+    A study that receives new files after being queued is queued again.
+    Directories that only hold our own routed-back reports are removed instead.
+    Studies that failed to process are queued again after retry_interval seconds.
+    Meant to be run on a background thread
+
+    Arguments:
+        routing_dir {string} -- folder where storescp puts routed studies
+        study_queue {queue.Queue} -- bounded queue of (study dir, time of detection)
+        poll_interval {float} -- seconds between scans of the routing folder
+        settle_time {float} -- seconds a study directory must stay unchanged
+        failed_queue {queue.Queue} -- optional queue the worker puts failed study dirs on
+        retry_interval {float} -- seconds to wait before retrying a failed study
+    """
+    queued = {}
+    retry_at = {}
+
+    while True:
+        # Nothing is waiting on this thread, so an error here would go unnoticed and
+        # leave the worker blocked on an empty queue. It is printed and polling goes on
+        try:
+            # A failed study keeps its modification time, so it is only queued again
+            # once we forget that it was queued. Waiting a while before that keeps us from
+            # hammering an archive that is down
+            while failed_queue is not None and not failed_queue.empty():
+                retry_at[failed_queue.get_nowait()] = time.time() + retry_interval
+            for study_dir, when in list(retry_at.items()):
+                if time.time() >= when:
+                    queued.pop(study_dir, None)
+                    del retry_at[study_dir]
+
+            subdirs = [os.path.join(routing_dir, d) for d in os.listdir(routing_dir) if
+                        os.path.isdir(os.path.join(routing_dir, d))]
+
+            # Forget about studies that have been processed and removed, so that
+            # a resent study is picked up again
+            queued = {d: mtime for d, mtime in queued.items() if d in subdirs}
+
+            for study_dir in subdirs:
+                try:
+                    mtime = os.stat(study_dir).st_mtime
+                except FileNotFoundError:
+                    continue
+
+                if queued.get(study_dir) != mtime and time.time() - mtime >= settle_time:
+                    # Our own reports come back to us through Orthanc. They are cleaned up
+                    # here rather than queued, since there is nothing to run inference on
+                    if remove_report_only_study(study_dir):
+                        continue
+
+                    # This blocks while the queue is full, so that a burst of routed
+                    # studies does not pile up in memory
+                    study_queue.put((study_dir, time.time()))
+                    queued[study_dir] = mtime
+        except Exception as e:
+            print(f"Error watching {routing_dir}: {e!r}")
+
+        time.sleep(poll_interval)
+
+def run_worker(routing_dir, inference_agent, report_sender, prediction_cache=None, report_save_path=None, queue_size=16):
+    """Keeps the inference agent resident and processes studies from the routing
+    folder as they arrive, printing per-study latency metrics. Runs until interrupted
+
+    Arguments:
+        routing_dir {string} -- folder where storescp puts routed studies
+        inference_agent {UNetInferenceAgent} -- agent with loaded model
+        report_sender {DicomSender} -- sender connected to the storage archive
+        prediction_cache {PredictionCache} -- optional cache of earlier predictions
+        report_save_path {string} -- optional path to also write the report DICOM file to
+        queue_size {int} -- maximum number of studies waiting to be processed
+    """
+    study_queue = queue.Queue(maxsize=queue_size)
+    failed_queue = queue.Queue()
+    threading.Thread(target=watch_routing_folder, args=(routing_dir, study_queue),
+                     kwargs=dict(failed_queue=failed_queue), daemon=True).start()
+
+    print(f"Watching {routing_dir} for routed studies...")
+    latencies = []
+
+    try:
+        while True:
+            study_dir, detected = study_queue.get()
+            started = time.time()
+
+            try:
+                if not process_study(study_dir, inference_agent, report_sender, prediction_cache, report_save_path):
+                    print(f"Could not find series for inference in {study_dir}.")
+                    continue
+            except Exception as e:
+                # A broken study should not bring the worker down. The watcher queues it
+                # again later, since the cause may be temporary (e.g. the archive is down)
+                print(f"Error processing {study_dir}: {e}")
+                failed_queue.put(study_dir)
+                continue
+
+            finished = time.time()
+            latencies.append(finished - detected)
+            print(f"Study {study_dir}: queue wait {started - detected:.2f}s, "
+                  f"processing {finished - started:.2f}s, latency {finished - detected:.2f}s. "
+                  f"Processed {len(latencies)} studies, mean latency {np.mean(latencies):.2f}s, "
+                  f"{study_queue.qsize()} waiting")
+    except KeyboardInterrupt:
+        print("Stopping worker.")
+
+if __name__ == "__main__":
+    # This code expects a command line argument with link to the directory containing
+    # routed studies, optionally followed by --watch to keep processing studies as they arrive
+    if len(sys.argv) not in (2, 3) or (len(sys.argv) == 3 and sys.argv[2] != "--watch"):
+        print("You should supply one command line argument pointing to the routing folder,",
+              "optionally followed by --watch. Exiting.")
+        sys.exit()
+
+    routing_dir = sys.argv[1]
+    prediction_cache_dir = r"/home/workspace/out/prediction_cache"
+
+    # TASK: Use the UNetInferenceAgent class and model parameter file from the previous section
+    # The agent also loads exported models: model.pt/model.onnx from export_model.py, or
+    # the int8 model_int8.pt produced by quantize_model.py in the previous section.
+    # The int8 model needs torch 1.8 or newer, both to produce and to load it
+    parameter_file_path = r"../model/model.pth"
+    inference_agent = UNetInferenceAgent(
+        device="cpu",
+        parameter_file_path=parameter_file_path)
+
+    # Cached predictions are only valid for the weights they were computed with
+    prediction_cache = PredictionCache(prediction_cache_dir, model_hash=file_hash(parameter_file_path))
+
+    # Reports go to the Orthanc server on port 4242 of the local machine, which
+    # accepts them under the HIPPOAI application entity title
+    with DicomSender("127.0.0.1", 4242, ae_title="HIPPOAI") as report_sender:
+        if len(sys.argv) == 3:
+            run_worker(routing_dir, inference_agent, report_sender, prediction_cache)
+            sys.exit()
+
+        # Find all subdirectories within the supplied directory. We assume that 
+        # one subdirectory contains a full study
+        subdirs = [os.path.join(routing_dir, d) for d in os.listdir(routing_dir) if
+                    os.path.isdir(os.path.join(routing_dir, d))]
+
+        # Try the latest directories first, skipping (and cleaning up) the ones
+        # that only hold reports we have sent earlier
+        for directory in sorted(subdirs, key=lambda dir: os.stat(dir).st_mtime, reverse=True):
+            if remove_report_only_study(directory):
+                continue
+            if process_study(directory, inference_agent, report_sender, prediction_cache):
+                break
+        else:
+            print("Could not find series for inference.")
@@ -0,0 +1,311 @@
+"""
+This file contains code that times performance-sensitive parts of the deployment pipeline.
+Pass benchmark names on the command line to run a subset of them, e.g.:
+
+    python run_benchmarks.py volume_assembly
+"""
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+
+import numpy as np
+import matplotlib.pyplot as plt
+import pydicom
+import torch
+
+from pydicom.uid import ExplicitVRLittleEndian, ImplicitVRLittleEndian
+from pynetdicom import AE, evt
+
+from PIL import Image
+
+from inference_dcm import load_dicom_volume_as_numpy_from_list, create_report, get_overlaid_images, create_report_dcm
+from dicom_sender import DicomSender, SECONDARY_CAPTURE_IMAGE_STORAGE
+from inference.UNetInferenceAgent import UNetInferenceAgent
+from networks.RecursiveUNet import UNet
+from export_model import load_eager_model, export_torchscript, export_onnx
+
+def make_series(n_slices=256, rows=256, columns=256):
+    """
+    Builds an in-memory series of uncompressed 16 bit DICOM slices in random order
+
+    Arguments:
+        n_slices {int} -- number of slices in the series
+        rows {int} -- rows in each slice
+        columns {int} -- columns in each slice
+
+    Returns:
+        list of PyDicom objects
+    """
+    rng = np.random.RandomState(0)
+    series = []
+    for i in rng.permutation(n_slices):
+        dcm = pydicom.Dataset()
+        dcm.file_meta = pydicom.Dataset()
+        dcm.file_meta.TransferSyntaxUID = pydicom.uid.ExplicitVRLittleEndian
+        dcm.is_little_endian = True
+        dcm.is_implicit_VR = False
+        dcm.InstanceNumber = int(i) + 1
+        dcm.Rows = rows
+        dcm.Columns = columns
+        dcm.SamplesPerPixel = 1
+        dcm.PhotometricInterpretation = "MONOCHROME2"
+        dcm.BitsAllocated = 16
+        dcm.BitsStored = 16
+        dcm.HighBit = 15
+        dcm.PixelRepresentation = 0
+        dcm.PixelData = rng.randint(0, 4096, (rows, columns)).astype(np.uint16).tobytes()
+        series.append(dcm)
+
+    return series
+
+def load_volume_stacked(dcmlist):
+    """
+    Previous implementation of load_dicom_volume_as_numpy_from_list, kept as a baseline
+
+    Arguments:
+        dcmlist {list of PyDicom objects} -- series to assemble
+
+    Returns:
+        3D volume
+    """
+    slices = [np.flip(dcm.pixel_array).T for dcm in sorted(dcmlist, key=lambda dcm: dcm.InstanceNumber)]
+    return np.stack(slices, 2)
+
+def measure(function, *args):
+    """
+    Runs the function once, measuring wall time and peak traced memory
+
+    Returns:
+        tuple of (result, seconds, peak megabytes)
+    """
+    tracemalloc.start()
+    start = time.time()
+    result = function(*args)
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, elapsed, peak / 2**20
+
+def benchmark_volume_assembly(n_slices=256):
+    """
+    Compares wall time and peak memory of assembling a series into a volume
+    with the preallocated loader against the previous stacking implementation
+
+    Arguments:
+        n_slices {int} -- number of slices in the series
+    """
+    series = make_series(n_slices)
+
+    reference, elapsed, peak = measure(load_volume_stacked, series)
+    print(f"stacked: {elapsed:.3f}s, peak {peak:.1f} MB")
+
+    for max_workers in (1, 8):
+        (volume, _), elapsed, peak = measure(load_dicom_volume_as_numpy_from_list, make_series(n_slices), max_workers)
+        print(f"preallocated, {max_workers} threads: {elapsed:.3f}s, peak {peak:.1f} MB, "
+              f"identical: {np.array_equal(volume, reference)}")
+
+# Largest absolute logit difference to the eager model that counts as equivalent.
+# The fused model is expected to be bit-identical, exported graphs may reorder float math
+LOGIT_TOLERANCE = 1e-4
+
+def benchmark_runtimes(n_volumes=10, volume_shape=(36, 64, 64)):
+    """
+    Compares agent startup time and per-volume CPU latency of the eager model
+    with the fused inference variant and exported TorchScript and ONNX models
+
+    Arguments:
+        n_volumes {int} -- number of volumes to time inference on
+        volume_shape {tuple} -- shape of the volumes
+    """
+    out_dir = tempfile.mkdtemp()
+    model_path = os.path.join(out_dir, "model.pth")
+    torch.manual_seed(0)
+    torch.save(UNet(num_classes=3).state_dict(), model_path)
+
+    model = load_eager_model(model_path)
+    export_torchscript(model, os.path.join(out_dir, "model.pt"))
+    export_onnx(model, os.path.join(out_dir, "model.onnx"))
+
+    volume = np.random.RandomState(0).rand(*volume_shape)
+    batch = torch.from_numpy(volume[:, None].astype(np.single))
+    reference = None
+
+    # The eager UNet is passed in explicitly, otherwise the agent builds the fused InferenceUNet
+    runs = [("model.pth (eager)", dict(model=UNet(num_classes=3))),
+            ("model.pth (fused)", {}),
+            ("model.pt", {}),
+            ("model.onnx", {})]
+
+    for name, kwargs in runs:
+        start = time.time()
+        agent = UNetInferenceAgent(parameter_file_path=os.path.join(out_dir, name.split()[0]), device="cpu", **kwargs)
+        startup = time.time() - start
+
+        # Equivalence is checked on the logits, since label maps hide small differences
+        agent.model.eval()
+        with torch.no_grad():
+            logits = agent.model(batch.to(agent.device)).cpu().numpy()
+        if reference is None:
+            reference = logits
+        difference = np.max(np.abs(logits - reference))
+
+        start = time.time()
+        for _ in range(n_volumes):
+            agent.single_volume_inference_unpadded(volume)
+        latency = (time.time() - start) / n_volumes
+
+        print(f"{name}: startup {1000 * startup:.1f} ms, {1000 * latency:.1f} ms/volume, "
+              f"max logit difference to eager {difference:.2e}, "
+              f"within {LOGIT_TOLERANCE:g}: {difference <= LOGIT_TOLERANCE}, "
+              f"bit-identical: {np.array_equal(logits, reference)}")
+
+def make_report_header():
+    """
+    Builds a DICOM header with the elements that create_report shows
+
+    Returns:
+        PyDicom object
+    """
+    header = pydicom.Dataset()
+    header.PatientName = "Benchmark^Patient"
+    header.PatientID = "0"
+    header.Modality = "MR"
+    header.StudyDescription = "Brain"
+    header.SeriesDescription = "HippoCrop"
+    header.SliceThickness = 1.0
+    header.PixelSpacing = [1.0, 1.0]
+    header.ImagePositionPatient = [0.0, 0.0, 0.0]
+    header.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+    return header
+
+def get_overlaid_image_baseline(slice, mask, size, color1, color2):
+    """
+    Previous implementation of get_overlaid_image, kept as a baseline
+    """
+    slice = np.flip((slice / np.max(slice)) * 0xff).T.astype(np.uint8)
+    colored_slice = (plt.get_cmap(color1)(slice)[:, :, :3] * 255).astype(np.uint8)
+    pil_i = Image.fromarray(colored_slice).resize(size)
+
+    mask = np.flip((mask / np.max(mask)) * 0xff).T.astype(np.uint8)
+    colored_mask = (plt.get_cmap(color2)(mask)[:, :, :3] * 255).astype(np.uint8)
+    mask_pil = Image.fromarray(colored_mask).resize(size)
+
+    return Image.blend(pil_i, mask_pil, alpha=0.5)
+
+def benchmark_report(n_reports=20, volume_shape=(36, 64, 64)):
+    """
+    Times report generation on its own, and compares the overlays against the
+    previous per-slice colormap, resize and blend implementation
+
+    Arguments:
+        n_reports {int} -- number of reports to time
+        volume_shape {tuple} -- shape of the volume, HippoCrop sized by default
+    """
+    rng = np.random.RandomState(0)
+    volume = rng.randint(1, 4096, volume_shape).astype(np.uint16)
+    pred = rng.randint(0, 3, volume_shape)
+    header = make_report_header()
+    inference = {"anterior": 1000, "posterior": 1000, "total": 2000}
+
+    # The first report loads fonts and builds colormap lookup tables
+    start = time.time()
+    create_report(inference, header, volume, pred)
+    print(f"first report: {1000 * (time.time() - start):.1f} ms")
+
+    start = time.time()
+    for _ in range(n_reports):
+        create_report(inference, header, volume, pred)
+    print(f"create_report: {1000 * (time.time() - start) / n_reports:.1f} ms/report")
+
+    slice_nums = [volume_shape[2]//3, volume_shape[2]//2, volume_shape[2]*3//4]
+    size = (volume_shape[1]*3, volume_shape[0]*5)
+
+    start = time.time()
+    for _ in range(n_reports):
+        baseline = [get_overlaid_image_baseline(volume[:, :, n], pred[:, :, n], size, "Greys", "Reds") for n in slice_nums]
+    baseline_time = (time.time() - start) / n_reports
+
+    start = time.time()
+    for _ in range(n_reports):
+        overlays = get_overlaid_images(volume[:, :, slice_nums], pred[:, :, slice_nums], size, "Greys", "Reds")
+    overlay_time = (time.time() - start) / n_reports
+
+    # Blending before resizing differs from the baseline only by rounding and by clipping of resampling overshoot
+    difference = max(np.max(np.abs(np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16)))
+                     for a, b in zip(baseline, overlays))
+    print(f"overlays: baseline {1000 * baseline_time:.1f} ms, lookup tables {1000 * overlay_time:.1f} ms, "
+          f"max pixel difference {difference}")
+
+def start_storage_scp(port, received):
+    """
+    Starts a pynetdicom Storage SCP that stands in for the archive, accepting
+    Secondary Capture datasets and keeping their SOP Instance UIDs
+
+    Arguments:
+        port {int} -- port to listen on
+        received {list} -- received SOP Instance UIDs are appended to it
+
+    Returns:
+        server, call shutdown() on it when done
+    """
+    def handle_store(event):
+        received.append(event.dataset.SOPInstanceUID)
+        return 0x0000
+
+    ae = AE(ae_title="HIPPOAI")
+    ae.add_supported_context(SECONDARY_CAPTURE_IMAGE_STORAGE, [ExplicitVRLittleEndian, ImplicitVRLittleEndian])
+    return ae.start_server(("127.0.0.1", port), block=False, evt_handlers=[(evt.EVT_C_STORE, handle_store)])
+
+def benchmark_store(n_reports=20, port=11112):
+    """
+    Times sending reports to a local stand-in archive over a reused association,
+    against opening a new association for every report as storescu does, and
+    checks that the archive confirmed and received every report
+
+    Arguments:
+        n_reports {int} -- number of reports to send
+        port {int} -- port of the stand-in archive
+    """
+    volume = np.random.RandomState(0).randint(1, 4096, (36, 64, 64)).astype(np.uint16)
+    pred = np.random.RandomState(1).randint(0, 3, volume.shape)
+    header = make_report_header()
+    header.StudyInstanceUID = pydicom.uid.generate_uid()
+    report = create_report({"anterior": 1000, "posterior": 1000, "total": 2000}, header, volume, pred)
+    reports = [create_report_dcm(header, report) for _ in range(n_reports)]
+
+    received = []
+    server = start_storage_scp(port, received)
+    try:
+        start = time.time()
+        for report_dcm in reports:
+            with DicomSender("127.0.0.1", port, ae_title="HIPPOAI") as sender:
+                sender.send(report_dcm)
+        per_report = (time.time() - start) / n_reports
+        print(f"new association per report: {1000 * per_report:.1f} ms/report")
+
+        start = time.time()
+        with DicomSender("127.0.0.1", port, ae_title="HIPPOAI") as sender:
+            for report_dcm in reports:
+                sender.send(report_dcm)
+        reused = (time.time() - start) / n_reports
+        print(f"reused association: {1000 * reused:.1f} ms/report")
+    finally:
+        server.shutdown()
+
+    expected = [report_dcm.SOPInstanceUID for report_dcm in reports] * 2
+    print(f"received {len(received)} of {len(expected)} reports, in order: {received == expected}")
+
+BENCHMARKS = {
+    "volume_assembly": benchmark_volume_assembly,
+    "runtimes": benchmark_runtimes,
+    "report": benchmark_report,
+    "store": benchmark_store,
+}
+
+if __name__ == "__main__":
+    for name in (sys.argv[1:] or BENCHMARKS.keys()):
+        print(f"Running {name} benchmark...")
+        BENCHMARKS[name]()
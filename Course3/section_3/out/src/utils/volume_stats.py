@@ -50,4 +50,213 @@ def Jaccard3d(a, b):
     # the Dice3D function from above to do the computation ;)
     jaccard = np.sum(np.logical_and(a, b)) / np.sum(np.logical_or(a, b))
 
-    return jaccard
\ No newline at end of file
+    return jaccard
+
+def ConfusionMatrix3d(a, b, num_classes=3):
+    """
+    This will count voxels for every combination of predicted and ground truth
+    class of two 3-dimensional label volumes in a single pass. All of the
+    metrics below are derived from these counts
+
+    Arguments:
+        a {Numpy array} -- 3D array with predicted labels in [0..num_classes)
+        b {Numpy array} -- 3D array with ground truth labels in [0..num_classes)
+        num_classes {int} -- number of classes, including background
+
+    Returns:
+        Numpy array of shape [num_classes, num_classes] where element [i, j]
+        is the number of voxels predicted as class i with ground truth class j
+    """
+    if len(a.shape) != 3 or len(b.shape) != 3:
+        raise Exception(f"Expecting 3 dimensional inputs, got {a.shape} and {b.shape}")
+
+    if a.shape != b.shape:
+        raise Exception(f"Expecting inputs of the same shape, got {a.shape} and {b.shape}")
+
+    # Every (predicted, ground truth) pair maps to a unique bin
+    pairs = a.ravel().astype(np.int64) * num_classes + b.ravel()
+    return np.bincount(pairs, minlength=num_classes ** 2).reshape(num_classes, num_classes)
+
+def MetricsFromConfusion(cm):
+    """
+    This will compute similarity metrics from confusion matrices. Works on a single
+    matrix as well as on a stack of matrices, one per volume.
+
+    dice, jaccard and sensitivity match Dice3d, Jaccard3d and sklearn's recall_score
+    with average='weighted' respectively. specificity treats everything but background
+    as foreground. The per-class metrics are one-vs-rest for every class except
+    background, i.e. [anterior, posterior] for the hippocampus labels
+
+    Arguments:
+        cm {Numpy array} -- [..., K, K] array of matrices returned by ConfusionMatrix3d
+
+    Returns:
+        Dictionary of Numpy arrays of shape [...] (overall metrics)
+        and [..., K-1] (per-class metrics)
+    """
+    cm = np.asarray(cm, dtype=np.float64)
+    labels = np.arange(cm.shape[-1])
+
+    total = cm.sum(axis=(-2, -1))
+    tp = np.diagonal(cm, axis1=-2, axis2=-1)
+    pred = cm.sum(axis=-1)
+    gt = cm.sum(axis=-2)
+    intersection = cm[..., 1:, 1:].sum(axis=(-2, -1))
+
+    # Metrics are undefined (nan) for classes that are absent from both volumes
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            # Dice3d sums label values rather than counting foreground voxels
+            "dice": 2 * intersection / ((pred * labels).sum(axis=-1) + (gt * labels).sum(axis=-1)),
+            "jaccard": intersection / (total - cm[..., 0, 0]),
+            "sensitivity": tp.sum(axis=-1) / total,
+            "specificity": cm[..., 0, 0] / gt[..., 0],
+            "dice_per_class": (2 * tp / (pred + gt))[..., 1:],
+            "jaccard_per_class": (tp / (pred + gt - tp))[..., 1:],
+            "sensitivity_per_class": (tp / gt)[..., 1:],
+            "specificity_per_class": ((total[..., None] - pred - gt + tp) / (total[..., None] - gt))[..., 1:]}
+
+def VolumeMetrics3d(a, b, num_classes=3):
+    """
+    This will compute all similarity metrics of MetricsFromConfusion
+    for two 3-dimensional label volumes
+
+    Arguments:
+        a {Numpy array} -- 3D array with predicted labels
+        b {Numpy array} -- 3D array with ground truth labels
+        num_classes {int} -- number of classes, including background
+
+    Returns:
+        Dictionary of floats (overall metrics) and lists of floats (per-class metrics)
+    """
+    metrics = MetricsFromConfusion(ConfusionMatrix3d(a, b, num_classes))
+    return {k: v.tolist() for k, v in metrics.items()}
+
+def BatchVolumeMetrics3d(preds, gts, num_classes=3):
+    """
+    This will compute all similarity metrics of MetricsFromConfusion
+    for many pairs of 3-dimensional label volumes. Volumes in different
+    pairs may have different shapes
+
+    Arguments:
+        preds {list of Numpy arrays} -- 3D arrays with predicted labels
+        gts {list of Numpy arrays} -- 3D arrays with ground truth labels
+        num_classes {int} -- number of classes, including background
+
+    Returns:
+        Dictionary of Numpy arrays of shape [N] (overall metrics) and
+        [N, K-1] (per-class metrics)
+    """
+    return MetricsFromConfusion(np.stack([ConfusionMatrix3d(a, b, num_classes) for a, b in zip(preds, gts)]))
+
+class VolumeMetricsAccumulator:
+    """
+    Accumulates the confusion matrix of one volume from consecutive batches
+    of slices, so that predictions do not have to be kept until the whole volume
+    is done. Also keeps Dice of every slice. Accumulators of different parts of
+    the same volume can be merged
+    """
+    def __init__(self, num_classes=3):
+        self.num_classes = num_classes
+        self.confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+        self.slice_dice = []
+
+    def update(self, a, b):
+        """
+        Adds a batch of slices
+
+        Arguments:
+            a {Numpy array} -- [N, Y, Z] array with predicted labels
+            b {Numpy array} -- [N, Y, Z] array with ground truth labels
+
+        Returns:
+            self
+        """
+        if a.shape != b.shape:
+            raise Exception(f"Expecting inputs of the same shape, got {a.shape} and {b.shape}")
+
+        # One bincount gives a confusion matrix per slice: every slice gets its own K*K bins
+        k = self.num_classes
+        offsets = (np.arange(a.shape[0]) * k * k)[:, None, None]
+        pairs = a.astype(np.int64) * k + b + offsets
+        cm = np.bincount(pairs.ravel(), minlength=a.shape[0] * k * k).reshape(-1, k, k)
+
+        self.confusion += cm.sum(axis=0)
+        self.slice_dice.extend(MetricsFromConfusion(cm)["dice"].tolist())
+        return self
+
+    def merge(self, other):
+        """
+        Adds slices accumulated by another accumulator, which are
+        assumed to follow the slices of this one
+
+        Returns:
+            self
+        """
+        self.confusion += other.confusion
+        self.slice_dice.extend(other.slice_dice)
+        return self
+
+    def result(self):
+        """
+        Computes metrics of the accumulated volume
+
+        Returns:
+            Dictionary of metrics of MetricsFromConfusion as floats and lists of
+            floats, plus slice_dice with Dice of every slice (nan for slices
+            where both prediction and ground truth are empty)
+        """
+        metrics = {k: v.tolist() for k, v in MetricsFromConfusion(self.confusion).items()}
+        metrics["slice_dice"] = list(self.slice_dice)
+        return metrics
+
+class TestSetMetricsAccumulator:
+    """
+    Collects per-volume stats of a test set and keeps running sums of the
+    metrics that are averaged over the whole set. Accumulators of different
+    shards of the test set can be merged
+    """
+    MEAN_KEYS = ("dice", "jaccard", "sensitivity")
+
+    def __init__(self):
+        self.volume_stats = {}
+        self.sums = dict.fromkeys(self.MEAN_KEYS, 0.0)
+
+    def add(self, index, stats):
+        """
+        Adds stats of one volume
+
+        Arguments:
+            index {int} -- position of the volume in the test set, used for ordering
+            stats {dict} -- per-volume stats, must contain dice, jaccard and sensitivity
+
+        Returns:
+            self
+        """
+        self.volume_stats[index] = stats
+        for k in self.MEAN_KEYS:
+            self.sums[k] += stats[k]
+        return self
+
+    def merge(self, other):
+        """
+        Adds volumes collected by another accumulator
+
+        Returns:
+            self
+        """
+        self.volume_stats.update(other.volume_stats)
+        for k in self.MEAN_KEYS:
+            self.sums[k] += other.sums[k]
+        return self
+
+    def result(self):
+        """
+        Returns:
+            Dictionary with volume_stats, ordered by index, and overall means.
+            Means of an empty test set are NaN
+        """
+        n = len(self.volume_stats)
+        return {
+            "volume_stats": [self.volume_stats[i] for i in sorted(self.volume_stats)],
+            "overall": {f"mean_{k}": self.sums[k] / n if n else float("nan") for k in self.MEAN_KEYS}}